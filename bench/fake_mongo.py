@@ -0,0 +1,155 @@
+import asyncio
+
+import mongomock
+from mongomock.collection import Collection
+from mongomock.database import Database
+from mongomock.filtering import filter_applies
+
+from utils.mongo import CURSOR_METHODS, SYNC_METHODS
+
+
+class CallCounter:
+    def __init__(self, latency: float = 0.0):
+        # simulated round-trip time of every call
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self) -> None:
+        self.calls += 1
+        # always yield to the loop, like a real round-trip
+        await asyncio.sleep(self.latency)
+
+
+class InMemoryCursor:
+    def __init__(self, cursor, counter: CallCounter):
+        self._cursor = iter(cursor)
+        self._raw = cursor
+        self._counter = counter
+        self._fetched = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._raw, name)
+
+        def chain(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if result is self._raw:
+                self._cursor = iter(result)
+                return self
+            return result
+
+        return chain
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # the first batch is one round-trip
+        if not self._fetched:
+            self._fetched = True
+            await self._counter.call()
+        document = next(self._cursor, None)
+        if document is None:
+            raise StopAsyncIteration
+        return document
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def to_list(self, length: int | None = None) -> list:
+        await self._counter.call()
+        documents = list(self._cursor)
+        return documents if length is None else documents[:length]
+
+    async def close(self) -> None:
+        pass
+
+
+# mongomock behind the async driver's interface, without worker threads so
+# the benchmark measures the handlers and not thread hand-offs
+class InMemoryMongo:
+    def __init__(self, target, counter: CallCounter):
+        self._target = target
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, (mongomock.MongoClient, Database, Collection)):
+            return InMemoryMongo(attr, self._counter)
+
+        if not callable(attr):
+            return attr
+
+        if name in SYNC_METHODS:
+            return lambda *args, **kwargs: InMemoryMongo(
+                attr(*args, **kwargs), self._counter
+            )
+
+        if name == "find":
+            return lambda *args, **kwargs: InMemoryCursor(
+                attr(*args, **kwargs), self._counter
+            )
+
+        async def call(*args, **kwargs):
+            await self._counter.call()
+            if name == "aggregate":
+                result = aggregate(self._target, *args, **kwargs)
+            else:
+                result = attr(*args, **kwargs)
+            return (
+                InMemoryCursor(result, self._counter)
+                if name in CURSOR_METHODS
+                else result
+            )
+
+        return call
+
+    def __getitem__(self, name: str):
+        return InMemoryMongo(self._target[name], self._counter)
+
+
+def aggregate(collection: Collection, pipeline: list, **kwargs):
+    # mongomock can't run a $lookup with a sub-pipeline, which the statistics
+    # use, the sub-pipeline is run on its own and joined to every document
+    for index, stage in enumerate(pipeline):
+        lookup = stage.get("$lookup")
+        if not lookup or "pipeline" not in lookup:
+            continue
+
+        documents = list(collection.aggregate(pipeline[:index]))
+        joined = list(collection.database[lookup["from"]].aggregate(lookup["pipeline"]))
+        for document in documents:
+            document[lookup["as"]] = joined
+
+        staged = collection.database["bench_lookup"]
+        staged.drop()
+        if documents:
+            staged.insert_many(documents)
+        return aggregate(staged, pipeline[index + 1 :])
+
+    return collection.aggregate(pipeline, **kwargs)
+
+
+def iter_documents_by_id(self, filter):
+    # mongomock scans the whole collection even for an _id lookup, which every
+    # update does on the users, the bench would measure the scan and not the bot
+    document_id = filter.get("_id") if isinstance(filter, dict) else None
+    if document_id is None or isinstance(document_id, dict):
+        return iter_documents(self, filter)
+
+    try:
+        document = self._store[document_id]
+    except (KeyError, TypeError):
+        return iter(())
+    return iter([document] if filter_applies(filter, document) else [])
+
+
+iter_documents = Collection._iter_documents
+Collection._iter_documents = iter_documents_by_id
+
+
+def in_memory_mongo(latency: float = 0.0) -> tuple[InMemoryMongo, CallCounter]:
+    counter = CallCounter(latency)
+    return InMemoryMongo(mongomock.MongoClient(), counter), counter
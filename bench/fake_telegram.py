@@ -0,0 +1,169 @@
+import itertools
+from datetime import datetime
+
+from pyrogram import Client, ContinuePropagation, StopPropagation, enums, types
+from pyrogram.handlers import CallbackQueryHandler, MessageHandler
+
+from bench.fake_mongo import CallCounter
+
+BOT_ID = 1
+BOT_USERNAME = "masa_bench_bot"
+
+
+# a pyrogram client that never connects, updates are dispatched to the real
+# handlers like pyrogram's dispatcher does and API calls are answered locally
+class FakeClient(Client):
+    def __init__(self, api_latency: float = 0.0):
+        super().__init__("masa_bench", in_memory=True, no_updates=True)
+        self.me = types.User(
+            id=BOT_ID, is_bot=True, first_name="MASA", username=BOT_USERNAME
+        )
+        self.api = CallCounter(api_latency)
+        self.errors = 0
+        self.filter_errors = 0
+        self.groups: dict[int, list] = {}
+        # the last message sent to every chat, scenarios press its buttons
+        self.last_messages: dict[int, types.Message] = {}
+        self._message_ids = itertools.count(1)
+        self._query_ids = itertools.count(1)
+
+    def add_handler(self, handler, group: int = 0):
+        self.groups.setdefault(group, []).append(handler)
+        return handler, group
+
+    async def dispatch(self, update) -> None:
+        if isinstance(update, types.Message):
+            handler_type = MessageHandler
+        else:
+            handler_type = CallbackQueryHandler
+
+        try:
+            for group in sorted(self.groups):
+                for handler in self.groups[group]:
+                    if not isinstance(handler, handler_type):
+                        continue
+
+                    # pyrogram logs a failing filter and tries the next handler
+                    try:
+                        if not await handler.check(self, update):
+                            continue
+                    except Exception:
+                        self.filter_errors += 1
+                        continue
+
+                    try:
+                        await handler.callback(self, update)
+                    except ContinuePropagation:
+                        continue
+                    except StopPropagation:
+                        raise
+                    except Exception:
+                        self.errors += 1
+                    break
+        except StopPropagation:
+            pass
+
+    # synthetic updates
+
+    def user(self, user_id: int) -> types.User:
+        return types.User(id=user_id, is_bot=False, first_name=f"user {user_id}")
+
+    def chat(self, chat_id: int) -> types.Chat:
+        if chat_id < 0:
+            return types.Chat(id=chat_id, type=enums.ChatType.SUPERGROUP)
+        return types.Chat(id=chat_id, type=enums.ChatType.PRIVATE)
+
+    def message(
+        self, chat_id: int, text: str, from_user_id: int | None = None, **kwargs
+    ) -> types.Message:
+        return types.Message(
+            client=self,
+            id=next(self._message_ids),
+            chat=self.chat(chat_id),
+            from_user=self.user(from_user_id or chat_id),
+            date=datetime.now(),
+            text=text,
+            **kwargs,
+        )
+
+    def callback_query(
+        self, user_id: int, data: str, chat_id: int | None = None
+    ) -> types.CallbackQuery:
+        chat_id = chat_id or user_id
+        message = self.last_messages.get(chat_id) or self._sent(chat_id, "")
+        return types.CallbackQuery(
+            client=self,
+            id=str(next(self._query_ids)),
+            from_user=self.user(user_id),
+            chat_instance=str(chat_id),
+            message=message,
+            data=data,
+        )
+
+    def button(self, chat_id: int, prefix: str) -> str | None:
+        # callback data of a button in the last message sent to the chat
+        message = self.last_messages.get(chat_id)
+        if not message or not message.reply_markup:
+            return None
+        for row in message.reply_markup.inline_keyboard:
+            for button in row:
+                if button.callback_data and button.callback_data.startswith(prefix):
+                    return button.callback_data
+        return None
+
+    def _sent(self, chat_id: int, text: str, reply_markup=None) -> types.Message:
+        message = types.Message(
+            client=self,
+            id=next(self._message_ids),
+            chat=self.chat(chat_id),
+            from_user=self.me,
+            date=datetime.now(),
+            text=text,
+            reply_markup=reply_markup,
+        )
+        self.last_messages[chat_id] = message
+        return message
+
+    # Telegram API methods the handlers use
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self.api.call()
+        return self._sent(chat_id, text, reply_markup)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self.api.call()
+        return self._sent(chat_id, "", kwargs.get("reply_markup"))
+
+    async def edit_message_text(
+        self, chat_id, message_id, text, reply_markup=None, **kwargs
+    ):
+        await self.api.call()
+        return self._sent(chat_id, text, reply_markup)
+
+    async def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        await self.api.call()
+        return True
+
+    async def delete_messages(self, chat_id, message_ids, *args, **kwargs):
+        await self.api.call()
+        return 1
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self.api.call()
+        return types.ChatMember(
+            status=enums.ChatMemberStatus.MEMBER, user=self.user(user_id)
+        )
+
+    async def get_chat(self, chat_id):
+        await self.api.call()
+        return self.chat(chat_id)
+
+    async def get_users(self, user_ids):
+        await self.api.call()
+        if isinstance(user_ids, list):
+            return [self.user(user_id) for user_id in user_ids]
+        return self.user(user_ids)
+
+    async def set_bot_commands(self, *args, **kwargs):
+        await self.api.call()
+        return True
@@ -0,0 +1,154 @@
+# replays a trace recorded with TRACE_FILE (see utils/trace.py) through the
+# real handlers against the bench's fake Telegram client and in-memory Mongo:
+#
+#   python -m bench.replay trace.jsonl --speed 10
+#   python -m bench.replay trace.jsonl --copies 10  # the same traffic from 10x users
+#
+# --speed 0 replays as fast as possible, the order of every user's updates is kept
+import argparse
+import asyncio
+import json
+import random
+
+from bench.run import (
+    GA_CHAT_ID,
+    STAFF_CHAT_ID,
+    Bench,
+    add_setup_arguments,
+    print_header,
+    setup,
+)
+from models.user import User
+from utils.config_cache import config_cache
+from utils.counters import user_serials
+
+# first user id of the replayed users
+REPLAY_USERS = 3_000_000
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class Replay:
+    def __init__(self, bench: Bench, trace: list[dict], copies: int):
+        self.bench = bench
+        self.trace = trace
+        self.copies = copies
+        pseudonyms = list(dict.fromkeys(event["user"] for event in trace))
+        self.user_ids = {
+            (copy, pseudonym): REPLAY_USERS + copy * len(pseudonyms) + index
+            for copy in range(copies)
+            for index, pseudonym in enumerate(pseudonyms)
+        }
+        self.serials: list[int] = []
+
+    async def seed(self) -> None:
+        # users who didn't start with /start in the trace were registered before it
+        first_events = {}
+        for event in self.trace:
+            first_events.setdefault(event["user"], event)
+
+        admins, users = [], []
+        for (copy, pseudonym), user_id in self.user_ids.items():
+            event = first_events[pseudonym]
+            if event["admin"]:
+                admins.append(user_id)
+            elif event.get("command") != "/start":
+                serial = await user_serials.next()
+                users.append(User(user_id, serial, filled_form=True).to_doc())
+                self.serials.append(serial)
+
+        if admins:
+            await config_cache.update({"$addToSet": {"admins_list": {"$each": admins}}})
+        if users:
+            await self.bench.db_client.masaBotDB.users.insert_many(users)
+
+    def update(self, event: dict, user_id: int):
+        client = self.bench.client
+        if event["chat"] == "staff":
+            chat_id = STAFF_CHAT_ID
+        elif event["chat"] == "group":
+            chat_id = GA_CHAT_ID
+        else:
+            chat_id = user_id
+
+        if event["type"] == "callback_query":
+            data = event["data"]
+            # state buttons carry a nonce, press the one the bot just sent
+            if data.endswith(":*"):
+                data = client.button(chat_id, data[:-1]) or data
+            return client.callback_query(user_id, data, chat_id=chat_id)
+
+        # message content isn't recorded, media is replayed as text of the same length
+        words = []
+        if "command" in event:
+            words.append(event["command"])
+            if event["serial"] and self.serials:
+                words.append(str(random.choice(self.serials)))
+        padding = event["length"] - len(" ".join(words))
+        if padding > 0 or not words:
+            words.append("x" * max(padding, 1))
+        return client.message(chat_id, " ".join(words), from_user_id=user_id)
+
+    async def replay_event(
+        self,
+        event: dict,
+        user_id: int,
+        due: float,
+        previous: asyncio.Event | None,
+        done: asyncio.Event,
+    ) -> None:
+        try:
+            await asyncio.sleep(due - asyncio.get_running_loop().time())
+            if previous:
+                await previous.wait()
+            await self.bench.send(self.update(event, user_id))
+        finally:
+            done.set()
+
+    def flows(self, speed: float) -> list:
+        started = asyncio.get_running_loop().time()
+        flows, last_events = [], {}
+        for copy in range(self.copies):
+            offset = 0.0
+            for event in self.trace:
+                offset += event["delay"]
+                due = started + offset / speed if speed else started
+                user_id = self.user_ids[(copy, event["user"])]
+
+                done = asyncio.Event()
+                previous = last_events.get(user_id)
+                last_events[user_id] = done
+                flows.append(self.replay_event(event, user_id, due, previous, done))
+        return flows
+
+
+async def main(args) -> None:
+    trace = load_trace(args.trace)
+    bench = await setup(args)
+    replay = Replay(bench, trace, args.copies)
+    await replay.seed()
+
+    print_header()
+    await bench.run(f"replay x{args.copies}", replay.flows(args.speed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded update trace")
+    parser.add_argument("trace", help="JSON-lines file recorded with TRACE_FILE")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="replay speed, e.g. 10 for ten times faster, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--copies",
+        type=int,
+        default=1,
+        help="replay the trace from this many disjoint sets of users at once",
+    )
+    add_setup_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
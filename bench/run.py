@@ -0,0 +1,240 @@
+# offline throughput benchmark, drives the real handlers with synthetic updates
+# against a fake Telegram client and an in-memory Mongo, run from the repo root:
+#
+#   pip install -r bench/requirements.txt
+#   python -m bench.run --users 10000 --db-latency 0.002
+#
+# compare the printed numbers between commits, absolute values depend on the machine
+import argparse
+import asyncio
+import os
+import time
+
+# utils.log reads the log channel when imported
+os.environ.setdefault("LOG_CHANNEL_ID", "-1000")
+
+from pyrogram import Client
+
+import utils.outbox
+from bench.fake_mongo import in_memory_mongo
+from bench.fake_telegram import FakeClient
+from models.config import Config
+from modules.admins import statistics_cache
+from modules.handlers import register_handlers
+from utils.bans import ban_list
+from utils.config_cache import config_cache
+from utils.counters import user_serials
+from utils.digest import staff_digest
+from utils.flood import flood_guard
+from utils.fsm import conversations
+from utils.outbox import outbox
+from utils.statistics import statistics_counters
+from utils.user_cache import user_cache
+
+ADMIN_ID = 1000
+STAFF_CHAT_ID = -1001
+GA_CHAT_ID = -1002
+FORM_LINK = "https://forms.example.com/masa"
+
+# first user id of every scenario, so scenarios don't share users
+START_USERS = 1_000_000
+CONTACT_STAFF_USERS = 2_000_000
+
+# large but finite, token buckets divide by their rate
+UNLIMITED = 1e9
+
+
+class Bench:
+    def __init__(self, client: FakeClient, db_client, db_calls, workers: int):
+        self.client = client
+        self.db_client = db_client
+        self.db_calls = db_calls
+        self.latencies: list[float] = []
+        # pyrogram handles at most `workers` updates at once
+        self._workers = asyncio.Semaphore(workers)
+
+    async def send(self, update) -> None:
+        async with self._workers:
+            started = time.perf_counter()
+            await self.client.dispatch(update)
+            self.latencies.append(time.perf_counter() - started)
+
+    async def run(self, name: str, flows: list) -> None:
+        self.latencies = []
+        db_calls, api_calls = self.db_calls.calls, self.client.api.calls
+        errors = self.client.errors + self.client.filter_errors
+
+        started = time.perf_counter()
+        await asyncio.gather(*flows)
+        elapsed = time.perf_counter() - started
+
+        updates = len(self.latencies)
+        latencies = sorted(self.latencies)
+        errors = self.client.errors + self.client.filter_errors - errors
+        per_update = max(updates, 1)
+        print(
+            f"{name:<15} {updates:>8} {updates / elapsed:>10.0f} "
+            f"{percentile(latencies, 0.5) * 1000:>8.2f} "
+            f"{percentile(latencies, 0.99) * 1000:>8.2f} "
+            f"{(self.db_calls.calls - db_calls) / per_update:>9.2f} "
+            f"{(self.client.api.calls - api_calls) / per_update:>10.2f} "
+            f"{errors:>6}"
+        )
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[int(q * (len(values) - 1))]
+
+
+async def start_flow(bench: Bench, user_id: int) -> None:
+    await bench.send(bench.client.message(user_id, "/start"))
+
+
+async def contact_staff_flow(bench: Bench, user_id: int) -> None:
+    client = bench.client
+    await bench.send(client.message(user_id, "/start"))
+    await bench.send(client.callback_query(user_id, "filled_form"))
+    await bench.send(client.callback_query(user_id, "contact_staff"))
+    await bench.send(client.message(user_id, "I need to talk to someone"))
+    # press the confirm button of the prompt the bot just sent
+    confirm = client.button(user_id, "confirm:") or "confirm:"
+    await bench.send(client.callback_query(user_id, confirm))
+
+
+async def statistics_flow(bench: Bench, cached: bool) -> None:
+    if not cached:
+        statistics_cache.invalidate()
+    await bench.send(bench.client.callback_query(ADMIN_ID, "statistics"))
+
+
+def lift_telegram_limits() -> None:
+    # the outbox spreads sends over Telegram's limits, 10k replies would take
+    # minutes, the bench measures the bot and not the limits
+    utils.outbox.GROUP_RATE = utils.outbox.GROUP_BURST = UNLIMITED
+    utils.outbox.PRIVATE_RATE = utils.outbox.PRIVATE_BURST = UNLIMITED
+
+
+async def setup(args) -> Bench:
+    client = FakeClient(api_latency=args.api_latency)
+    db_client, db_calls = in_memory_mongo(latency=args.db_latency)
+
+    if not args.telegram_limits:
+        lift_telegram_limits()
+    outbox.bind(
+        rate=25 if args.telegram_limits else UNLIMITED, workers=args.outbox_workers
+    )
+    staff_digest.bind(window=args.digest_window)
+    # the synthetic users send as fast as the bench can, not like people
+    flood_guard.bind(rate=UNLIMITED, burst=UNLIMITED)
+    config_cache.bind(db_client.masaBotDB.config)
+    user_cache.bind(db_client.masaBotDB.users, max_size=args.user_cache_size)
+    ban_list.bind(db_client.masaBotDB.bans)
+    statistics_counters.bind(db_client.masaBotDB)
+    user_serials.bind(db_client.masaBotDB.counters, block_size=args.serial_block)
+    conversations.bind(db_client.masaBotDB.conversations)
+
+    # a configured bot, like after the admin set it up, indexes aren't created
+    # since mongomock treats the partial unique index on custom names as a
+    # plain unique one
+    config = Config(
+        admins_list=[ADMIN_ID],
+        super_admin_id=ADMIN_ID,
+        staff_chat_id=STAFF_CHAT_ID,
+        assessment_form_link=FORM_LINK,
+        ga_chat_id=GA_CHAT_ID,
+    )
+    await config_cache.insert(config)
+    await ban_list.load()
+    await conversations.load()
+    await db_client.masaBotDB.statistics.insert_one(
+        {"staff_replies_counter": 0, "users_messages_counter": 0}
+    )
+    await user_serials.seed(db_client.masaBotDB.users)
+
+    register_handlers(client, db_client)
+    return Bench(client, db_client, db_calls, args.workers)
+
+
+def print_header() -> None:
+    print(
+        f"{'scenario':<15} {'updates':>8} {'updates/s':>10} {'p50 ms':>8} "
+        f"{'p99 ms':>8} {'db/update':>9} {'api/update':>10} {'errors':>6}"
+    )
+
+
+def add_setup_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=Client.WORKERS,
+        help="updates handled at once, like pyrogram's workers",
+    )
+    parser.add_argument("--outbox-workers", type=int, default=4)
+    parser.add_argument("--serial-block", type=int, default=1)
+    parser.add_argument("--user-cache-size", type=int, default=10_000)
+    parser.add_argument(
+        "--digest-window",
+        type=float,
+        default=0,
+        help="seconds staff notifications are collected, 0 disables the digest",
+    )
+    parser.add_argument(
+        "--db-latency", type=float, default=0, help="seconds per Mongo round-trip"
+    )
+    parser.add_argument(
+        "--api-latency", type=float, default=0, help="seconds per Telegram API call"
+    )
+    parser.add_argument(
+        "--telegram-limits",
+        action="store_true",
+        help="keep the outbox rate limits instead of lifting them",
+    )
+
+
+async def main(args) -> None:
+    bench = await setup(args)
+    scenarios = args.scenarios.split(",")
+
+    print_header()
+
+    if "start" in scenarios:
+        flows = [start_flow(bench, START_USERS + i) for i in range(args.users)]
+        await bench.run("start", flows)
+
+    if "contact_staff" in scenarios:
+        flows = [
+            contact_staff_flow(bench, CONTACT_STAFF_USERS + i)
+            for i in range(args.flows)
+        ]
+        await bench.run("contact_staff", flows)
+
+    if "statistics" in scenarios:
+        flows = [statistics_flow(bench, args.cached) for _ in range(args.requests)]
+        await bench.run("statistics", flows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MASA Hotline Bot benchmark")
+    parser.add_argument(
+        "--scenarios",
+        default="start,contact_staff,statistics",
+        help="comma separated scenarios to run",
+    )
+    parser.add_argument(
+        "--users", type=int, default=10_000, help="concurrent new users sending /start"
+    )
+    parser.add_argument(
+        "--flows", type=int, default=1_000, help="concurrent contact staff flows"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=1_000, help="admin statistics requests"
+    )
+    parser.add_argument(
+        "--cached",
+        action="store_true",
+        help="let statistics requests share the cached result",
+    )
+    add_setup_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
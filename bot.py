@@ -1,17 +1,32 @@
 import asyncio
-import logging
 import os
 import signal
 
-import requests
-from pyrogram import Client, filters
+import aiohttp
+from pyrogram import Client
 from pyrogram.types import BotCommand, BotCommandScopeAllPrivateChats
 
 from models.config import Config
-from modules import admins, staff, users
-from utils.flask_server import run_server
-from utils.log import log
+from modules import admins
+from modules.handlers import register_handlers
+from utils.bans import ban_list
+from utils.broadcast import broadcasts
+from utils.config_cache import config_cache
+from utils.counters import user_serials
+from utils.digest import staff_digest
+from utils.flood import flood_guard
+from utils.fsm import conversations
+from utils.http_server import health_server
+from utils.indexes import ensure_indexes
+from utils.log import DEBUG, ERROR, WARNING, log, log_shipper
+from utils.membership import ga_members
+from utils.metrics import instrument_client, metrics, mongo_command_timer
 from utils.mongo import connect_to_db
+from utils.outbox import outbox
+from utils.statistics import statistics_counters
+from utils.trace import trace_recorder
+from utils.user_cache import user_cache
+from utils.watchdog import loop_watchdog
 
 # user dotenv file in development
 is_production = os.getenv("PRODUCTION", None)
@@ -20,18 +35,53 @@ if not is_production or is_production == "0":
 
     dotenv.load_dotenv()
 
-# disable flask development server logging
-logger = logging.getLogger("werkzeug")
-logger.setLevel(logging.WARNING)
-
-# this is to prevent the service from sleeping in free hostings ervices
-run_server()
-
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 DB_URI = os.getenv("DB_URI", "")
+# set to 0 to use the sync driver in worker threads instead of the async driver
+DB_ASYNC = os.getenv("DB_ASYNC", "1") != "0"
+
+# serials reserved per counter round-trip, unused ones are skipped on restart
+SERIAL_BLOCK_SIZE = int(os.getenv("SERIAL_BLOCK_SIZE", "1"))
+
+# broadcast messages per second, Telegram allows about 30 for bots
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+
+# messages per second the bot sends in total, across all chats
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+
+# seconds staff chat notifications are collected into one digest, 0 disables it
+STAFF_DIGEST_WINDOW = float(os.getenv("STAFF_DIGEST_WINDOW", "0"))
+# a digest is sent early once it has this many notifications
+STAFF_DIGEST_MAX_EVENTS = int(os.getenv("STAFF_DIGEST_MAX_EVENTS", "20"))
+
+# seconds between full syncs of the general assembly members, 0 disables it
+GA_MEMBERS_SYNC_INTERVAL = float(os.getenv("GA_MEMBERS_SYNC_INTERVAL", "0"))
+
+# seconds a pending conversation (e.g. an unconfirmed reply) is kept
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "3600"))
+
+# JSON-lines file the shape of the traffic is recorded to, for bench/replay.py
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+# seconds statistics are counted in memory before being written
+STATISTICS_FLUSH_INTERVAL = float(os.getenv("STATISTICS_FLUSH_INTERVAL", "5"))
+
+# updates per second a user can send in a private chat, after a burst, and the
+# dropped updates within a minute that get the user banned for a while, 0
+# disables the bans
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "10"))
+FLOOD_BAN_THRESHOLD = int(os.getenv("FLOOD_BAN_THRESHOLD", "60"))
+FLOOD_BAN_MINUTES = int(os.getenv("FLOOD_BAN_MINUTES", "60"))
+
+# users kept in memory, the least recently looked up are evicted first
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
 ADMIN_ID = os.getenv("ADMIN_ID", "")
 
 if ADMIN_ID.isnumeric():
@@ -40,18 +90,64 @@ if ADMIN_ID.isnumeric():
 # the url of the service in hosting platform
 SERVICE_URL = os.getenv("SERVICE_URL")
 
+# port of the health and metrics endpoints
+PORT = int(os.getenv("PORT", "8000"))
+# the bot is reported as not ready when the event loop is late by more than this
+MAX_LOOP_LAG = float(os.getenv("MAX_LOOP_LAG", "1"))
+
+# event loop stalls longer than this are reported with the blocking stack
+WATCHDOG_THRESHOLD = float(os.getenv("WATCHDOG_THRESHOLD", "0.5"))
+# set to 1 in development to flag blocking calls made from the event loop
+WATCHDOG_DEV_MODE = os.getenv("WATCHDOG_DEV_MODE", "0") == "1"
+
 client: Client = Client(
     "MASA_Hotline_Bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN
 )
+# time Telegram API calls and every handler registered in main()
+instrument_client(client)
 
 
-db_client = connect_to_db(DB_URI)
+mongo_client = connect_to_db(
+    DB_URI, use_async=DB_ASYNC, event_listeners=[mongo_command_timer]
+)
+db_client = mongo_client
 # Use a test database for development
 if not is_production:
-    db_client = db_client.test2
+    db_client = mongo_client.test2
+
+config_cache.bind(db_client.masaBotDB.config)
+user_cache.bind(db_client.masaBotDB.users, max_size=USER_CACHE_SIZE)
+ban_list.bind(db_client.masaBotDB.bans)
+flood_guard.bind(
+    rate=FLOOD_RATE,
+    burst=FLOOD_BURST,
+    ban_threshold=FLOOD_BAN_THRESHOLD,
+    ban_minutes=FLOOD_BAN_MINUTES,
+)
+statistics_counters.bind(db_client.masaBotDB, interval=STATISTICS_FLUSH_INTERVAL)
+outbox.bind(rate=OUTBOX_RATE, workers=OUTBOX_WORKERS)
+staff_digest.bind(window=STAFF_DIGEST_WINDOW, max_events=STAFF_DIGEST_MAX_EVENTS)
+health_server.bind(client, mongo_client, max_loop_lag=MAX_LOOP_LAG)
+health_server.add_collector(outbox.metrics)
+health_server.add_collector(metrics.collect)
+user_serials.bind(db_client.masaBotDB.counters, block_size=SERIAL_BLOCK_SIZE)
+conversations.bind(db_client.masaBotDB.conversations, ttl=CONVERSATION_TTL)
+trace_recorder.bind(TRACE_FILE)
+broadcasts.bind(
+    db_client.masaBotDB,
+    rate=BROADCAST_RATE,
+    workers=BROADCAST_WORKERS,
+    done_markup=admins.back_keyboard(),
+)
 
 
 async def main() -> None:
+    # this is to prevent the service from sleeping in free hostings ervices
+    await health_server.start(PORT)
+    loop_watchdog.start(
+        client, threshold=WATCHDOG_THRESHOLD, dev_mode=WATCHDOG_DEV_MODE
+    )
+
     try:
         await client.start()
     except ConnectionError:
@@ -65,13 +161,13 @@ async def main() -> None:
     # NOTE: Staff commands are set when staff chat is set not here.
 
     # check config health
-    config = db_client.masaBotDB.config.find_one({})
+    config = await config_cache.refresh()
     if not config:
         config = Config(
             admins_list=[int(ADMIN_ID)],
             super_admin_id=int(ADMIN_ID),
         )
-        db_client.masaBotDB.config.insert_one(config.as_dict())
+        await config_cache.insert(config)
         try:
             await client.send_message(
                 ADMIN_ID,
@@ -84,8 +180,8 @@ async def main() -> None:
             await log(client, "Tell the admin to start the bot!")
 
     else:
-        admins_list = config["admins_list"]
-        if not config["staff_chat_id"]:
+        admins_list = config.admins_list
+        if not config.staff_chat_id:
             for admin_id in admins_list:
                 try:
                     await client.send_message(
@@ -95,7 +191,7 @@ async def main() -> None:
                 except:
                     await log(client, f"Failed to message admin {admin_id}")
 
-        if not config["assessment_form_link"]:
+        if not config.assessment_form_link:
             for admin_id in admins_list:
                 try:
                     await client.send_message(
@@ -105,150 +201,42 @@ async def main() -> None:
                 except:
                     await log(client, f"Failed to message admin {admin_id}")
 
+    # bans moved from the config document to their own collection
+    await ban_list.migrate()
+    await ban_list.load()
+
+    # pending conversations, state filters read them from memory
+    await conversations.load()
+
     # create statistics documnet in the first bot run
-    statistics = db_client.masaBotDB.statistics.find_one({})
+    statistics = await db_client.masaBotDB.statistics.find_one({})
     if not statistics:
-        db_client.masaBotDB.statistics.insert_one(
+        await db_client.masaBotDB.statistics.insert_one(
             {"staff_replies_counter": 0, "users_messages_counter": 0}
         )
 
-    # Filters
-    def is_admin(_, __, update):
-        config = db_client.masaBotDB.config.find_one({})
-        return bool(
-            config and update.from_user and update.from_user.id in config["admins_list"]
-        )
-
-    admin_chat_filter = filters.create(is_admin)
-
-    def not_banned(_, client, update):
-        banned_users = db_client.masaBotDB.config.find_one({}, {"banned_users": 1})[
-            "banned_users"
-        ]
-        return bool(
-            update.from_user
-            and update.from_user.id not in banned_users
-            and update.from_user.id != client.me.id
-        )
-
-    bot_user_filter = filters.create(not_banned) & ~admin_chat_filter
-
-    def is_staff_chat(_, __, update):
-        config = db_client.masaBotDB.config.find_one({})
-        return bool(
-            config and update.chat and update.chat.id == config["staff_chat_id"]
-        )
+    # create missing indexes and report their status in the log channel
+    await ensure_indexes(client, db_client.masaBotDB)
 
-    staff_chat_filter = filters.create(is_staff_chat)
+    # seed the serial counter from existing users on the first run
+    await user_serials.seed(db_client.masaBotDB.users)
 
-    # User-Bot interaction
-    @client.on_message(bot_user_filter & filters.command("start"))
-    async def _(client, message):
-        await users.start_handler(client, message, db_client)
+    # continue broadcasts that were interrupted by a restart
+    await broadcasts.resume(client)
 
-    @client.on_callback_query(bot_user_filter & filters.regex("^filled_form$"))
-    async def _(client, callback_query):
-        await users.filled_form_handler(client, callback_query, db_client)
+    # keep the config snapshot, cached users, bans and conversations
+    # consistent with writes from other bot instances
+    config_cache.watch(client)
+    user_cache.watch(client)
+    ban_list.watch(client)
+    conversations.watch(client)
 
-    @client.on_callback_query(bot_user_filter & filters.regex("^refill_form$"))
-    async def _(client, callback_query):
-        await users.refill_form_handler(callback_query, db_client)
+    async def ga_chat_id():
+        return (await config_cache.get()).ga_chat_id
 
-    @client.on_callback_query(bot_user_filter & filters.regex("^contact_staff$"))
-    async def _(client, callback_query):
-        await users.contact_staff_handler(client, callback_query, db_client)
+    ga_members.sync_periodically(client, ga_chat_id, GA_MEMBERS_SYNC_INTERVAL)
 
-    @client.on_callback_query(bot_user_filter & filters.regex("^user_back$"))
-    async def _(client, callback_query):
-        await users.back_handler(client, callback_query, db_client)
-
-    @client.on_message(filters.private & bot_user_filter & filters.text)
-    async def _(client, message):
-        await users.text_handler(message)
-
-    # Staff-Bot interaction
-    @client.on_message(staff_chat_filter & filters.command("reply"))
-    async def _(client, message):
-        await staff.reply_handler(client, message, db_client)
-
-    @client.on_message(staff_chat_filter & filters.command("send"))
-    async def _(client, message):
-        await staff.send_handler(client, message, db_client)
-
-    @client.on_message(staff_chat_filter & filters.command("assign"))
-    async def _(client, message):
-        await staff.assign_name_handler(client, message, db_client)
-
-    @client.on_message(staff_chat_filter & filters.command("help"))
-    async def _(client, message):
-        await staff.help_handler(message)
-
-    # Admin-Bot interaction
-    @client.on_message(admin_chat_filter & filters.command("start") & filters.private)
-    async def _(client, message):
-        await admins.start_handler(client, message, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^set_staff_chat$"))
-    async def _(client, callback_query):
-        await admins.set_staff_chat_handler(client, callback_query, db_client)
-
-    @client.on_callback_query(
-        admin_chat_filter & filters.regex("^set_assessment_form_link$")
-    )
-    async def _(client, callback_query):
-        await admins.set_assesment_form_link_handler(client, callback_query, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^set_ga_chat$"))
-    async def _(client, callback_query):
-        await admins.set_ga_chat_handler(client, callback_query, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^broadcast$"))
-    async def _(client, callback_query):
-        await admins.broadcast_handler(client, callback_query, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^ban_user$"))
-    async def _(client, callback_query):
-        await admins.ban_user_handler(client, callback_query, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^unban_user$"))
-    async def _(client, callback_query):
-        await admins.unban_button_handler(callback_query, db_client)
-
-    @client.on_message(
-        admin_chat_filter & filters.private & filters.regex(r"^/unban_\d+$")
-    )
-    async def _(client, message):
-        await admins.unban_user_handler(message, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^add_admin$"))
-    async def _(client, callback_query):
-        await admins.add_admin_handler(client, callback_query, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^manage_admins$"))
-    async def _(client, callback_query):
-        await admins.manage_admins_handler(client, callback_query, db_client)
-
-    @client.on_message(
-        admin_chat_filter & filters.private & filters.regex(r"^/remove_admin_\d+$")
-    )
-    async def _(client, message):
-        await admins.remove_admin_handler(message, db_client)
-
-    @client.on_message(
-        admin_chat_filter
-        & filters.private
-        & filters.regex(r"^/transfer_super_admin_\d+$")
-    )
-    async def _(client, message):
-        await admins.transfer_super_admin_handler(client, message, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^statistics$"))
-    async def _(client, callback_query):
-        await admins.statistics_handler(callback_query, db_client)
-
-    @client.on_callback_query(admin_chat_filter & filters.regex("^back$"))
-    async def _(client, callback_query):
-        await admins.back_handler(client, callback_query, db_client)
+    register_handlers(client, db_client)
 
     async def idle():
         shutdown_event = asyncio.Event()
@@ -261,38 +249,50 @@ async def main() -> None:
 
         await log(client, "Bot is up and running.")
         await shutdown_event.wait()
+
+        # write the delivery records of running broadcasts and the counted
+        # statistics and send the pending staff notifications and what is left
+        # in the log queue before disconnecting
+        await broadcasts.stop()
+        await statistics_counters.flush()
+        await staff_digest.flush(client)
+        await log_shipper.flush(client)
+        await trace_recorder.flush()
+        # then send what is left in the outbox, for a limited time
+        await outbox.drain()
         await client.stop()
 
     print("Bot is running.")
 
     # prevent service sleep
-    async def ping_server():
-        if SERVICE_URL:
-            res = requests.get(SERVICE_URL)
-            return await log(client, res.text)
-        else:
+    async def ping_server(session: aiohttp.ClientSession):
+        async with session.get(SERVICE_URL) as res:
+            # only kept in the log file, pings would flood the log channel
+            await log(client, await res.text(), level=DEBUG)
+
+    async def keep_up():
+        if not SERVICE_URL:
             return await log(
                 client,
                 "Warning: $SERVICE_URL is not set, the service can sleep at anytime.",
+                level=WARNING,
             )
 
-    async def keep_up():
-        m = await ping_server()
-        while True:
-            try:
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                try:
+                    await ping_server(session)
+                except Exception as e:
+                    await log(client, str(e), level=ERROR)
                 await asyncio.sleep(60)
-                await m.delete()
-                m = await ping_server()
-            except Exception as e:
-                await log(client, str(e))
-                pass
 
     asyncio.create_task(keep_up())
     try:
         await idle()
     except Exception as e:
         try:
-            await log(client, f"Bot crashed due to {e}")
+            await log(client, f"Bot crashed due to {e}", level=ERROR)
         except:
             print(f"Bot crashed due to {e}")
 
@@ -1,16 +1,67 @@
+# attribute names and the document keys they are stored under
+FIELDS = {
+    "id": "_id",
+    "serial_number": "serial_number",
+    "filled_form": "filled_form",
+    "custom_name": "custom_name",
+    # when the user's first message not yet replied to by the staff was sent
+    "awaiting_reply_since": "awaiting_reply_since",
+}
+ATTRIBUTES = {key: name for name, key in FIELDS.items()}
+
+
+# slotted, a cached user takes a fraction of the memory of its document, users
+# loaded with a projection only have the projected attributes set
 class User:
+    __slots__ = (*FIELDS, "_display_name")
+
     def __init__(
-        self, id: int, serial_number: int, filled_form: bool, custom_name=None
+        self,
+        id: int,
+        serial_number: int,
+        filled_form: bool,
+        custom_name=None,
+        awaiting_reply_since=None,
     ):
         self.id = id
         self.serial_number = serial_number
         self.filled_form = filled_form
         self.custom_name = custom_name
+        self.awaiting_reply_since = awaiting_reply_since
+        self._display_name = None
+
+    @classmethod
+    def from_doc(cls, doc: dict, fields=FIELDS):
+        user = cls.__new__(cls)
+        for name in fields:
+            setattr(user, name, doc.get(FIELDS[name]))
+        user._display_name = None
+        return user
 
-    def as_dict(self):
+    @staticmethod
+    def projection(fields=FIELDS) -> dict:
+        projection = {FIELDS[name]: 1 for name in fields}
+        # mongo returns the _id unless told otherwise
+        projection.setdefault("_id", 0)
+        return projection
+
+    def to_doc(self) -> dict:
         return {
-            "_id": self.id,
-            "serial_number": self.serial_number,
-            "filled_form": self.filled_form,
-            "custom_name": self.custom_name,
+            key: getattr(self, name)
+            for name, key in FIELDS.items()
+            if hasattr(self, name)
         }
+
+    def apply(self, fields: dict) -> None:
+        # `fields` as in a $set of the document
+        for key, value in fields.items():
+            setattr(self, ATTRIBUTES[key], value)
+        self._display_name = None
+
+    @property
+    def display_name(self) -> str:
+        # how staff and admins see a user, e.g. <b>#12 (PTSD)</b>
+        if self._display_name is None:
+            custom_name = f" ({self.custom_name})" if self.custom_name else ""
+            self._display_name = f"<b>#{self.serial_number}{custom_name}</b>"
+        return self._display_name
@@ -1,9 +1,56 @@
-import asyncio
-
-from pymongo import MongoClient
-from pyrogram import Client, enums, errors, filters, types
-
-from utils.log import log
+import re
+from datetime import timedelta
+
+from pymongo import AsyncMongoClient, ReadPreference
+from pyrogram import Client, errors, types
+
+from models.config import Config
+from models.user import User
+from utils.bans import ban_list
+from utils.broadcast import broadcasts
+from utils.cache import CachedResult
+from utils.config_cache import config_cache
+from utils.context import UpdateContext
+from utils.fsm import callback_nonce, conversations, utc_now
+from utils.log import WARNING, log
+from utils.outbox import outbox
+from utils.statistics import (
+    day_of,
+    hour_of,
+    response_percentile,
+    statistics_counters,
+)
+from utils.user_cache import user_cache
+
+# repeated taps on the statistics button share one computation
+statistics_cache = CachedResult(ttl=30)
+trends_cache = CachedResult(ttl=60)
+
+# days shown in the admin panel trends
+TREND_DAYS = 7
+
+# labels of the first response time buckets, see utils/statistics.py
+RESPONSE_LABELS = {
+    "60": "1m",
+    "300": "5m",
+    "900": "15m",
+    "3600": "1h",
+    "14400": "4h",
+    "43200": "12h",
+    "86400": "1d",
+    "259200": "3d",
+}
+
+# users listed per page in the admin panel, small enough for Telegram's 4096 limit
+USERS_PAGE_SIZE = 50
+# only what the pages show is loaded
+PAGE_FIELDS = ("id", "serial_number", "custom_name")
+
+USER_LISTS = {
+    "filled": "Users who filled the form",
+    "not_filled": "Users who didn't fill the form",
+    "banned": "Banned Users",
+}
 
 
 def admin_keyboard(is_super_admin: bool = False):
@@ -60,37 +107,34 @@ def back_keyboard():
     return back_keyboard
 
 
-async def current_settings(client: Client, db_client: MongoClient):
-    config = db_client.masaBotDB.config.find_one({})
+async def current_settings(client: Client, config: Config | None):
     if not config:
         return "Error getting settings ❌"
 
-    if config["staff_chat_id"]:
+    if config.staff_chat_id:
         try:
-            staff_chat = await client.get_chat(config["staff_chat_id"])
+            staff_chat = await client.get_chat(config.staff_chat_id)
             staff_chat_title = staff_chat.title
         except Exception as e:
-            await log(client, f"Staff chat not Accesible, it says: {e}")
+            await log(client, f"Staff chat not Accesible, it says: {e}", level=WARNING)
             staff_chat_title = "Not Accesible."
 
     else:
         staff_chat_title = "Not set yet ⚠️"
 
-    if "ga_chat_id" in config and config["ga_chat_id"]:
+    if config.ga_chat_id:
         try:
-            ga_chat = await client.get_chat(config["ga_chat_id"])
+            ga_chat = await client.get_chat(config.ga_chat_id)
             ga_chat_title = ga_chat.title
         except Exception as e:
-            await log(client, f"GA chat not Accesible, it says: {e}")
+            await log(client, f"GA chat not Accesible, it says: {e}", level=WARNING)
             ga_chat_title = "Not Accesible."
 
     else:
         ga_chat_title = "Not set ⚠️"
 
     assessment_form_link = (
-        config["assessment_form_link"]
-        if config["assessment_form_link"]
-        else "Not set yet ⚠️"
+        config.assessment_form_link if config.assessment_form_link else "Not set yet ⚠️"
     )
 
     current_settings = (
@@ -101,28 +145,23 @@ async def current_settings(client: Client, db_client: MongoClient):
     return current_settings
 
 
-async def start_handler(client: Client, message: types.Message, db_client: MongoClient):
+async def start_handler(client: Client, message: types.Message, context: UpdateContext):
     admin = message.from_user
-    await client.stop_listening(chat_id=admin.id)
-    await client.stop_listening(
-        listener_type=enums.ListenerTypes.CALLBACK_QUERY, chat_id=admin.id
-    )
+    await conversations.clear(admin.id, admin.id)
 
+    config = await context.config()
     reply_text = (
         f"Hello {admin.first_name}!, How is work going in MASA office?\n\n"
         "<b><u>Bot Current Settings</u></b>:\n\n"
-        f"{await current_settings(client, db_client)}"
+        f"{await current_settings(client, config)}"
     )
 
-    super_admin_id = db_client.masaBotDB.config.find_one({}, {"super_admin_id"})[
-        "super_admin_id"
-    ]
-    is_super_admin = admin.id == super_admin_id
-    await message.reply(reply_text, reply_markup=admin_keyboard(is_super_admin))
+    is_super_admin = admin.id == config.super_admin_id
+    await outbox.reply(message, reply_text, reply_markup=admin_keyboard(is_super_admin))
 
 
 async def set_staff_chat_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     admin = callback_query.from_user
     await callback_query.message.delete()
@@ -138,41 +177,34 @@ async def set_staff_chat_handler(
         resize_keyboard=True,
     )
 
-    await client.send_message(
+    await outbox.send_message(
+        client,
         admin.id,
         "Please use the button to choose the staff chat and share it with the bot",
         reply_markup=request_group_keyboard,
     )
-    while True:
-        try:
-            staff_chat_message = await client.listen(
-                chat_id=callback_query.from_user.id,
-                user_id=callback_query.from_user.id,
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
+    await conversations.set(admin.id, admin.id, "set_staff_chat")
 
-        if not staff_chat_message or (
-            staff_chat_message.text != "Cancel" and not staff_chat_message.chats_shared
-        ):
-            await staff_chat_message.reply("Please use one of the two buttons.")
-            continue
 
-        elif staff_chat_message.text == "Cancel":
-            return await start_handler(client, staff_chat_message, db_client)
+async def staff_chat_message_handler(
+    client: Client, message: types.Message, context: UpdateContext
+):
+    admin = message.from_user
+    if message.text == "Cancel":
+        return await start_handler(client, message, context)
 
-        staff_chat_id = staff_chat_message.chats_shared.chats[0].chat_id
-        db_client.masaBotDB.config.update_one(
-            {}, {"$set": {"staff_chat_id": staff_chat_id}}
-        )
-        break
+    elif not message.chats_shared:
+        return await outbox.reply(message, "Please use one of the two buttons.")
+
+    staff_chat_id = message.chats_shared.chats[0].chat_id
+    await config_cache.update({"$set": {"staff_chat_id": staff_chat_id}})
+    await conversations.clear(admin.id, admin.id)
 
     staff_chat = await client.get_chat(staff_chat_id)
 
-    super_admin_id = db_client.masaBotDB.config.find_one({}, {"super_admin_id"})[
-        "super_admin_id"
-    ]
-    is_super_admin = admin.id == super_admin_id
+    # read after the update, the update's context still has the old staff chat
+    config = await config_cache.get()
+    is_super_admin = admin.id == config.super_admin_id
 
     try:
         await client.set_bot_commands(
@@ -187,96 +219,87 @@ async def set_staff_chat_handler(
             scope=types.BotCommandScopeChat(staff_chat_id),
         )
 
-        await client.send_message(
+        await outbox.send_message(
+            client,
             staff_chat_id,
             "Hey <b>MASA team</b>!, I am your Hotline Manager Bot 🤖!\n\n"
             "I am looking forward to work with you 😇\n\n"
             "use /help to know how to use me!",
         )
     except errors.ChatWriteForbidden:
-        await staff_chat_message.reply(
+        await outbox.reply(
+            message,
             "Please give the bot the right to send messages in staff group and try again ❌\n\n"
             "<b><u>Bot Current Settings</u></b>:\n\n"
-            f"{await current_settings(client, db_client)}",
+            f"{await current_settings(client, config)}",
             reply_markup=admin_keyboard(is_super_admin),
         )
         return
 
-    await staff_chat_message.reply(
+    await outbox.reply(
+        message,
         f"{staff_chat.title} has been set as the new staff chat ✅\n\n"
         "<b><u>Bot Current Settings</u></b>:\n\n"
-        f"{await current_settings(client, db_client)}",
+        f"{await current_settings(client, config)}",
         reply_markup=admin_keyboard(is_super_admin),
     )
 
 
 async def set_assesment_form_link_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     await callback_query.message.edit_text(
         "Please send the assessment form link", reply_markup=back_keyboard()
     )
 
     admin = callback_query.from_user
-    try:
-        assesssment_form_link_message = await client.listen(
-            filters.text, chat_id=admin.id
-        )
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
+    await conversations.set(admin.id, admin.id, "set_assessment_form_link")
 
-    form_link = assesssment_form_link_message.text
 
-    confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_assessment_form_set"
+async def form_link_message_handler(client: Client, message: types.Message):
+    admin = message.from_user
+    form_link = message.text
+    nonce = await conversations.set(
+        admin.id, admin.id, "confirm_assessment_form_link", form_link=form_link
     )
-    cancel_button = types.InlineKeyboardButton(
-        "Cancel ❌", callback_data="cancel_assessment_form_set"
+
+    confirm_button = types.InlineKeyboardButton(
+        "Confirm ✅", callback_data=f"confirm_assessment_form_set:{nonce}"
     )
+    cancel_button = types.InlineKeyboardButton("Cancel ❌", callback_data="back")
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
-    await callback_query.message.delete()
-
-    await assesssment_form_link_message.reply(
+    await outbox.reply(
+        message,
         "Are you sure you want to set:\n\n"
         f"{form_link}\n\n"
         "As the new assesssment form link?",
         reply_markup=options_keyboard,
     )
 
-    while True:
-        try:
-            callback_answer = await client.listen(
-                filters=filters.regex(
-                    r"^confirm_assessment_form_set$|^cancel_assessment_form_set$"
-                ),
-                chat_id=admin.id,
-                user_id=admin.id,
-                listener_type=enums.ListenerTypes.CALLBACK_QUERY,
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
-
-        if callback_answer and callback_answer.data == "confirm_assessment_form_set":
-            db_client.masaBotDB.config.update_one(
-                {}, {"$set": {"assessment_form_link": form_link}}
-            )
 
-            super_admin_id = db_client.masaBotDB.config.find_one(
-                {}, {"super_admin_id"}
-            )["super_admin_id"]
-            is_super_admin = admin.id == super_admin_id
-            return await callback_answer.message.edit_text(
-                "New assessment form link has been set succefully ✅\n\n",
-                reply_markup=back_keyboard(),
-            )
+async def confirm_form_link_handler(callback_query: types.CallbackQuery):
+    admin = callback_query.from_user
+    conversation = await conversations.pop(
+        admin.id,
+        admin.id,
+        callback_nonce(callback_query.data),
+        "confirm_assessment_form_link",
+    )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
 
-        elif callback_answer.data == "cancel_assessment_form_set":
-            return await back_handler(client, callback_answer, db_client)
+    form_link = conversation["data"]["form_link"]
+    await config_cache.update({"$set": {"assessment_form_link": form_link}})
+    return await callback_query.message.edit_text(
+        "New assessment form link has been set succefully ✅\n\n",
+        reply_markup=back_keyboard(),
+    )
 
 
 async def set_ga_chat_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     admin = callback_query.from_user
 
@@ -294,46 +317,44 @@ async def set_ga_chat_handler(
         resize_keyboard=True,
     )
 
-    await client.send_message(
+    await outbox.send_message(
+        client,
         admin.id,
         "Please use the buttons to change or remove the general assembly group chat (the bot must be in the group)\n\n"
         "<b><u>WARNING</u>: REMOVING THE GA GROUP CHECK WILL DISABLE THE GENERAL ASSEMBLY GROUP CHECK AND ANY USER CAN USE THE BOT.</b>",
         reply_markup=request_group_keyboard,
     )
-    while True:
-        try:
-            ga_chat_message = await client.listen(
-                chat_id=callback_query.from_user.id,
-                user_id=callback_query.from_user.id,
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
-
-        if not ga_chat_message or (
-            ga_chat_message.text not in ["Cancel", "Remove GA membership check"]
-            and not ga_chat_message.chats_shared
-        ):
-            await ga_chat_message.reply("Please use one of the buttons.")
-            continue
-
-        elif ga_chat_message.text == "Remove GA membership check":
-            db_client.masaBotDB.config.update_one({}, {"$set": {"ga_chat_id": None}})
-            return await ga_chat_message.reply(
-                "General assembly memebership check is disabled ✅\n\n"
-                "Anyone can use the bot now, to re-enable the check set a GA group chat.",
-                reply_markup=back_keyboard(),
-            )
+    await conversations.set(admin.id, admin.id, "set_ga_chat")
 
-        elif ga_chat_message.text == "Cancel":
-            return await start_handler(client, ga_chat_message, db_client)
 
-        ga_chat_id = ga_chat_message.chats_shared.chats[0].chat_id
-        db_client.masaBotDB.config.update_one({}, {"$set": {"ga_chat_id": ga_chat_id}})
-        break
+async def ga_chat_message_handler(
+    client: Client, message: types.Message, context: UpdateContext
+):
+    admin = message.from_user
+    if message.text == "Cancel":
+        return await start_handler(client, message, context)
+
+    elif message.text == "Remove GA membership check":
+        await config_cache.update({"$set": {"ga_chat_id": None}})
+        await conversations.clear(admin.id, admin.id)
+        return await outbox.reply(
+            message,
+            "General assembly memebership check is disabled ✅\n\n"
+            "Anyone can use the bot now, to re-enable the check set a GA group chat.",
+            reply_markup=back_keyboard(),
+        )
+
+    elif not message.chats_shared:
+        return await outbox.reply(message, "Please use one of the buttons.")
+
+    ga_chat_id = message.chats_shared.chats[0].chat_id
+    await config_cache.update({"$set": {"ga_chat_id": ga_chat_id}})
+    await conversations.clear(admin.id, admin.id)
 
     ga_chat = await client.get_chat(ga_chat_id)
 
-    await ga_chat_message.reply(
+    await outbox.reply(
+        message,
         f"<b>{ga_chat.title}</b> has been set as the new general assembly chat ✅\n\n"
         "Only members of this chat can use the bot, to disable the check:\n"
         'in the admin panel press "Set General Assembly Group" > "Remove GA membership check"',
@@ -341,71 +362,8 @@ async def set_ga_chat_handler(
     )
 
 
-async def set_assesment_form_link_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
-):
-    await callback_query.message.edit_text(
-        "Please send the assessment form link", reply_markup=back_keyboard()
-    )
-
-    admin = callback_query.from_user
-    try:
-        assesssment_form_link_message = await client.listen(
-            filters.text, chat_id=admin.id
-        )
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
-
-    form_link = assesssment_form_link_message.text
-
-    confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_assessment_form_set"
-    )
-    cancel_button = types.InlineKeyboardButton(
-        "Cancel ❌", callback_data="cancel_assessment_form_set"
-    )
-    options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
-
-    await assesssment_form_link_message.reply(
-        "Are you sure you want to set:\n\n"
-        f"{form_link}\n\n"
-        "As the new assesssment form link?",
-        reply_markup=options_keyboard,
-    )
-
-    while True:
-        try:
-            callback_answer = await client.listen(
-                filters=filters.regex(
-                    r"^confirm_assessment_form_set$|^cancel_assessment_form_set$"
-                ),
-                chat_id=admin.id,
-                user_id=admin.id,
-                listener_type=enums.ListenerTypes.CALLBACK_QUERY,
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
-
-        if callback_answer and callback_answer.data == "confirm_assessment_form_set":
-            db_client.masaBotDB.config.update_one(
-                {}, {"$set": {"assessment_form_link": form_link}}
-            )
-
-            super_admin_id = db_client.masaBotDB.config.find_one(
-                {}, {"super_admin_id"}
-            )["super_admin_id"]
-            is_super_admin = admin.id == super_admin_id
-            return await callback_answer.message.edit_text(
-                "New assessment form link has been set succefully ✅\n\n",
-                reply_markup=back_keyboard(),
-            )
-
-        elif callback_answer.data == "cancel_assessment_form_set":
-            return await back_handler(client, callback_answer, db_client)
-
-
 async def broadcast_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     await callback_query.message.edit_text(
         "Please Send the message you want to forward to all bot users.",
@@ -413,167 +371,134 @@ async def broadcast_handler(
     )
 
     admin = callback_query.from_user
-    try:
-        mess_to_brod = await client.listen(chat_id=admin.id, user_id=admin.id)
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
+    await conversations.set(admin.id, admin.id, "broadcast")
 
-    if not mess_to_brod:
-        return
 
-    confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_broadcast"
+async def broadcast_message_handler(
+    client: Client, message: types.Message, db_client: AsyncMongoClient
+):
+    admin = message.from_user
+    nonce = await conversations.set(
+        admin.id, admin.id, "confirm_broadcast", message_id=message.id
     )
-    cancel_button = types.InlineKeyboardButton(
-        "Cancel ❌", callback_data="cancel_broadcast"
+
+    confirm_button = types.InlineKeyboardButton(
+        "Confirm ✅", callback_data=f"confirm_broadcast:{nonce}"
     )
+    cancel_button = types.InlineKeyboardButton("Cancel ❌", callback_data="back")
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
-    users_count = db_client.masaBotDB.users.count_documents({})
-    await mess_to_brod.copy(admin.id)
-    await mess_to_brod.reply(
+    users_count = await db_client.masaBotDB.users.estimated_document_count()
+    await outbox.copy(message, admin.id)
+    await outbox.reply(
+        message,
         f"Are you sure you want to broadcast the previous message to all bot users ({users_count} users)?",
         reply_markup=options_keyboard,
     )
 
-    while True:
-        try:
-            callback_answer = await client.listen(
-                filters=filters.regex(r"^confirm_broadcast$|^cancel_broadcast$"),
-                chat_id=admin.id,
-                user_id=admin.id,
-                listener_type=enums.ListenerTypes.CALLBACK_QUERY,
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
-
-        if not callback_answer:
-            return
 
-        elif callback_answer.data == "confirm_broadcast":
-            await callback_answer.message.edit_text(
-                "Broadcast started, I will notify you when I finish."
-            )
-            bot_users = db_client.masaBotDB.users.find({})
-            sent = 0
-            for user in bot_users:
-                try:
-                    await mess_to_brod.copy(user["_id"])
-                    sent += 1
-                except errors.FloodWait as e:
-                    await asyncio.sleep(e.value + 1)
-                    await mess_to_brod.copy(user["_id"])
-                    sent += 1
-                except Exception as e:
-                    print(e)
-
-            await mess_to_brod.reply(
-                f"This message has been succefully broadcasted to {sent} of bot users  ✅",
-                reply_markup=back_keyboard(),
-                quote=True,
-            )
-            return
+async def confirm_broadcast_handler(
+    client: Client, callback_query: types.CallbackQuery
+):
+    admin = callback_query.from_user
+    conversation = await conversations.pop(
+        admin.id, admin.id, callback_nonce(callback_query.data), "confirm_broadcast"
+    )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
 
-        else:
-            return await back_handler(client, callback_answer, db_client)
+    # the confirmation message becomes the broadcast progress message
+    await broadcasts.start(
+        client,
+        admin.id,
+        conversation["data"]["message_id"],
+        callback_query.message,
+    )
 
 
 async def ban_user_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     admin = callback_query.from_user
 
     await callback_query.message.edit_text(
-        "Please send the serial number of the user to ban from the bot",
+        "Please send the serial number of the user to ban from the bot, "
+        "optionally followed by the number of days to ban him/her for (e.g `12 7`)",
         reply_markup=back_keyboard(),
     )
+    await conversations.set(admin.id, admin.id, "ban_user")
 
-    while True:
-        try:
-            user_serial_message = await client.listen(
-                filters.text, chat_id=admin.id, user_id=admin.id
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
 
-        if not user_serial_message:
-            return
+async def ban_user_message_handler(message: types.Message, db_client: AsyncMongoClient):
+    admin = message.from_user
+    text_match = re.match(r"^(\d+)(?:\s+(\d+))?$", message.text.strip())
+    if not text_match:
+        return await outbox.reply(
+            message,
+            "Please send a valid serial number, you can try again.",
+            reply_markup=back_keyboard(),
+        )
 
-        elif not user_serial_message.text.isnumeric():
-            await user_serial_message.reply(
-                "Please send a valid serial number, you can try again.",
-                reply_markup=back_keyboard(),
-            )
-            continue
+    serial_number, days = text_match.groups()
+    user_in_db = await user_cache.by_serial(int(serial_number))
 
-        user_in_db = db_client.masaBotDB.users.find_one(
-            {"serial_number": int(user_serial_message.text)}
+    if not user_in_db:
+        return await outbox.reply(
+            message,
+            f"There is no a bot user with the serial number: {serial_number}, you can try again.",
+            reply_markup=back_keyboard(),
         )
 
-        if not user_in_db:
-            await user_serial_message.reply(
-                f"There is no a bot user with the serial number: {user_serial_message.text}, you can try again.",
-                reply_markup=back_keyboard(),
-            )
-            continue
-        user_name = f"<b>#{user_in_db['serial_number']}{' ('+user_in_db['custom_name']+')' if user_in_db['custom_name'] else ''}</b>"
-
-        banned_users = db_client.masaBotDB.config.find_one({}, {"banned_users": 1})[
-            "banned_users"
-        ]
-        if user_in_db["_id"] in banned_users:
-            return await user_serial_message.reply(
-                f"This user {user_name} is already banned from the bot"
-            )
+    await conversations.clear(admin.id, admin.id)
+    user_name = user_in_db.display_name
 
-        db_client.masaBotDB.config.update_one(
-            {}, {"$push": {"banned_users": user_in_db["_id"]}}
+    if ban_list.is_banned(user_in_db.id):
+        return await outbox.reply(
+            message, f"This user {user_name} is already banned from the bot"
         )
 
-        return await user_serial_message.reply(
-            f"User {user_name} Has been banned from using the bot"
-        )
+    expires_at = utc_now() + timedelta(days=int(days)) if days else None
+    await ban_list.ban(user_in_db.id, user_in_db.serial_number, admin.id, expires_at)
+
+    return await outbox.reply(
+        message,
+        f"User {user_name} Has been banned from using the bot"
+        + (f" for {days} days" if days else ""),
+    )
 
 
 async def add_admin_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     admin = callback_query.from_user
     await callback_query.message.edit_text(
         "Please send the username of the user to add as an admin for the bot",
         reply_markup=back_keyboard(),
     )
+    await conversations.set(admin.id, admin.id, "add_admin")
 
-    while True:
-        try:
-            new_admin_username_message = await client.listen(
-                filters.text, chat_id=admin.id, user_id=admin.id
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
 
-        try:
-            new_admin = await client.get_users(new_admin_username_message.text)
-        except Exception as e:
-            print(f"fail to resolve new admin username, {e}")
-            await new_admin_username_message.reply("Please send a valid username.")
-        else:
-            db_client.masaBotDB.config.update_one(
-                {}, {"$push": {"admins_list": new_admin.id}}
-            )
-            await new_admin_username_message.reply(
-                f"@{new_admin.username} is now one of the bot admins."
-            )
-            return
+async def add_admin_message_handler(client: Client, message: types.Message):
+    admin = message.from_user
+    try:
+        new_admin = await client.get_users(message.text)
+    except Exception as e:
+        print(f"fail to resolve new admin username, {e}")
+        await outbox.reply(message, "Please send a valid username.")
+    else:
+        await config_cache.update({"$push": {"admins_list": new_admin.id}})
+        await conversations.clear(admin.id, admin.id)
+        await outbox.reply(
+            message, f"@{new_admin.username} is now one of the bot admins."
+        )
 
 
 async def manage_admins_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
-    config = db_client.masaBotDB.config.find_one(
-        {}, {"admins_list": 1, "super_admin_id": 1}
-    )
-    admins_ids_list, super_admin_id = config["admins_list"], config["super_admin_id"]
+    config = await config_cache.get()
+    admins_ids_list, super_admin_id = config.admins_list, config.super_admin_id
 
     if not callback_query.from_user.id == super_admin_id:
         return
@@ -596,67 +521,67 @@ async def manage_admins_handler(
     )
 
 
-async def remove_admin_handler(message: types.Message, db_client: MongoClient):
-    config = db_client.masaBotDB.config.find_one(
-        {}, {"admins_list": 1, "super_admin_id": 1}
-    )
-    admins_ids_list, super_admin_id = config["admins_list"], config["super_admin_id"]
+async def remove_admin_handler(message: types.Message, db_client: AsyncMongoClient):
+    config = await config_cache.get()
+    admins_ids_list, super_admin_id = config.admins_list, config.super_admin_id
 
     if not message.from_user.id == super_admin_id:
         return
 
     admin_to_remove_id = message.text.split("/remove_admin_")[-1]
     if not admin_to_remove_id.isnumeric():
-        await message.reply("Invalid admin id.")
+        await outbox.reply(message, "Invalid admin id.")
         return
 
     admin_to_remove_id = int(admin_to_remove_id)
     if admin_to_remove_id not in admins_ids_list:
-        await message.reply("There is no an admin with the specified id.")
+        await outbox.reply(message, "There is no an admin with the specified id.")
         return
 
     if admin_to_remove_id == message.from_user.id:
-        return await message.reply(
-            "You can't remove yourself from administratorship, transfer it to other user if you want."
+        return await outbox.reply(
+            message,
+            "You can't remove yourself from administratorship, transfer it to other user if you want.",
         )
 
-    db_client.masaBotDB.config.update_one(
-        {}, {"$pull": {"admins_list": admin_to_remove_id}}
-    )
+    await config_cache.update({"$pull": {"admins_list": admin_to_remove_id}})
 
-    await message.reply(f"Admin removed succefully ✅.")
+    await outbox.reply(message, f"Admin removed succefully ✅.")
 
 
 async def transfer_super_admin_handler(
-    client: Client, message: types.Message, db_client: MongoClient
+    client: Client, message: types.Message, db_client: AsyncMongoClient
 ):
-    config = db_client.masaBotDB.config.find_one(
-        {}, {"admins_list": 1, "super_admin_id": 1}
-    )
-    admins_ids_list, super_admin_id = config["admins_list"], config["super_admin_id"]
+    config = await config_cache.get()
+    admins_ids_list, super_admin_id = config.admins_list, config.super_admin_id
 
     if not message.from_user.id == super_admin_id:
         return
 
     admin_to_promote_id = message.text.split("/transfer_super_admin_")[-1]
     if not admin_to_promote_id.isnumeric():
-        await message.reply("Invalid admin id.")
+        await outbox.reply(message, "Invalid admin id.")
         return
 
     admin_to_promote_id = int(admin_to_promote_id)
     if admin_to_promote_id not in admins_ids_list:
-        await message.reply("There is no an admin with the specified id.")
+        await outbox.reply(message, "There is no an admin with the specified id.")
         return
 
     if admin_to_promote_id == message.from_user.id:
-        return await message.reply("You are already the superadmin.")
+        return await outbox.reply(message, "You are already the superadmin.")
 
-    confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_super_admin_transfer"
+    nonce = await conversations.set(
+        message.from_user.id,
+        message.from_user.id,
+        "confirm_super_admin_transfer",
+        admin_to_promote_id=admin_to_promote_id,
     )
-    cancel_button = types.InlineKeyboardButton(
-        "Cancel ❌", callback_data="cancel_super_admin_transfer"
+
+    confirm_button = types.InlineKeyboardButton(
+        "Confirm ✅", callback_data=f"confirm_super_admin_transfer:{nonce}"
     )
+    cancel_button = types.InlineKeyboardButton("Cancel ❌", callback_data="back")
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
     try:
@@ -669,157 +594,311 @@ async def transfer_super_admin_handler(
     except:
         new_superadmin_name = "This Admin"
 
-    await message.reply(
+    await outbox.reply(
+        message,
         f"Are you sure you want to transfer the SuperAdmin powers to {new_superadmin_name}?\n\n"
         "This will make you a regular admin and he/she will be able to remove you from administiration.",
         reply_markup=options_keyboard,
     )
 
-    while True:
-        try:
-            callback_answer = await client.listen(
-                filters=filters.regex(
-                    r"^confirm_super_admin_transfer$|^cancel_super_admin_transfer$"
-                ),
-                chat_id=message.from_user.id,
-                user_id=message.from_user.id,
-                listener_type=enums.ListenerTypes.CALLBACK_QUERY,
-            )
-        except (errors.ListenerStopped, asyncio.TimeoutError):
-            return
 
-        if callback_answer and callback_answer.data == "confirm_super_admin_transfer":
-            db_client.masaBotDB.config.update_one(
-                {}, {"$set": {"super_admin_id": admin_to_promote_id}}
-            )
-            return await callback_answer.message.edit_text(
-                f"Superadmin powers transferred succefully ✅",
-                reply_markup=back_keyboard(),
-            )
+async def confirm_super_admin_transfer_handler(callback_query: types.CallbackQuery):
+    admin = callback_query.from_user
+    conversation = await conversations.pop(
+        admin.id,
+        admin.id,
+        callback_nonce(callback_query.data),
+        "confirm_super_admin_transfer",
+    )
 
-        elif callback_answer.data == "cancel_super_admin_transfer":
-            return await back_handler(client, callback_answer, db_client)
+    # the superadmin may have changed while waiting for confirmation
+    super_admin_id = (await config_cache.get()).super_admin_id
+    if not conversation or admin.id != super_admin_id:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
+
+    admin_to_promote_id = conversation["data"]["admin_to_promote_id"]
+    await config_cache.update({"$set": {"super_admin_id": admin_to_promote_id}})
+    return await callback_query.message.edit_text(
+        f"Superadmin powers transferred succefully ✅",
+        reply_markup=back_keyboard(),
+    )
+
+
+async def hotline_statistics(db_client: AsyncMongoClient) -> dict:
+    users = db_client.masaBotDB.users
+    statistics = db_client.masaBotDB.statistics.with_options(
+        read_preference=ReadPreference.SECONDARY_PREFERRED
+    )
+
+    # the counters document and every users figure in a single round-trip
+    pipeline = [
+        {"$limit": 1},
+        {
+            "$lookup": {
+                "from": users.name,
+                "pipeline": [
+                    {
+                        "$facet": {
+                            "users_count": [{"$count": "count"}],
+                            "form_fillers_count": [
+                                {"$match": {"filled_form": True}},
+                                {"$count": "count"},
+                            ],
+                        }
+                    }
+                ],
+                "as": "users",
+            }
+        },
+        {"$unwind": "$users"},
+    ]
+    result = await (await statistics.aggregate(pipeline)).to_list()
+    stats = result[0]
+    users_count = stats["users"]["users_count"]
+    form_fillers_count = stats["users"]["form_fillers_count"]
+
+    return {
+        "staff_replies_counter": stats["staff_replies_counter"],
+        "users_messages_counter": stats["users_messages_counter"],
+        "users_count": users_count[0]["count"] if users_count else 0,
+        "form_fillers_count": (
+            form_fillers_count[0]["count"] if form_fillers_count else 0
+        ),
+    }
 
 
 async def statistics_handler(
-    callback_query: types.CallbackQuery, db_client: MongoClient
+    callback_query: types.CallbackQuery, db_client: AsyncMongoClient
 ):
     await callback_query.message.edit_text(
         "<b><i>Preparing Hotline statistics ⏳</i></b>"
     )
-    stats = db_client.masaBotDB.statistics.find_one({})
-    users_count = db_client.masaBotDB.users.count_documents({})
-    form_fillers_count = db_client.masaBotDB.users.count_documents(
-        {"filled_form": True}
+    stats = await statistics_cache.get(lambda: hotline_statistics(db_client))
+
+    stats_report_text = (
+        "<b><u>Hotline Statistics:</u></b>\n\n"
+        f"<b>Users who started the bot</b>: {stats['users_count']}.\n"
+        f"<b>Users who filled the form</b>: {stats['form_fillers_count']}.\n"
+        f"<b>Messages sent by the staff to bot users</b>: {stats['staff_replies_counter']}.\n"
+        f"<b>Messages sent by bot users to staff</b>: {stats['users_messages_counter']}."
     )
-    form_fillers = db_client.masaBotDB.users.find({"filled_form": True})
-    form_non_fillers = db_client.masaBotDB.users.find({"filled_form": False})
 
-    form_fillers_user_names = (
-        ".\n".join(
-            [
-                f"<b>#{user['serial_number']}{' ('+user['custom_name']+')' if user['custom_name'] else ''}</b>"
-                for user in form_fillers
-            ]
-        )
-        or "No users."
+    form_fillers_button = types.InlineKeyboardButton(
+        "Users who filled the form  📋", "users_page:filled:next:0"
+    )
+    form_non_fillers_button = types.InlineKeyboardButton(
+        "Users who didn't fill the form  📋", "users_page:not_filled:next:0"
+    )
+    trends_button = types.InlineKeyboardButton("Trends  📈", "trends")
+    back_button = types.InlineKeyboardButton("Go Back", "back")
+    statistics_keyboard = types.InlineKeyboardMarkup(
+        [
+            [form_fillers_button],
+            [form_non_fillers_button],
+            [trends_button],
+            [back_button],
+        ]
     )
 
-    form_non_fillers_user_names = (
-        ".\n".join(
-            [
-                f"<b>#{user['serial_number']}{' ('+user['custom_name']+')' if user['custom_name'] else ''}</b>"
-                for user in form_non_fillers
-            ]
-        )
-        or "No users"
+    await callback_query.message.edit_text(
+        stats_report_text, reply_markup=statistics_keyboard
     )
 
-    stats_report_text = (
-        "<b><u>Hotline Statistics:</u></b>\n\n"
-        f"<b>Users who started the bot</b>: {users_count}.\n"
-        f"<b>Users who filled the form</b>: {form_fillers_count}.\n"
-        f"<b>Messages sent by the staff to bot users</b>: {stats['staff_replies_counter']}.\n"
-        f"<b>Messages sent by bot users to staff</b>: {stats['users_messages_counter']}.\n\n\n"
-        f"<b>Users who filled the form</b>:\n{form_fillers_user_names}.\n\n"
-        f"<b>Users who didn't fill the form</b>:\n{form_non_fillers_user_names}."
+
+def response_time(counters: dict, q: float) -> str:
+    bound = response_percentile(counters, q)
+    if bound is None:
+        return "-"
+    if bound == "inf":
+        return "> 3d"
+    return f"≤ {RESPONSE_LABELS[bound]}"
+
+
+def trend_line(counters: dict) -> str:
+    return (
+        f"{counters.get('new_users', 0)} new users, "
+        f"{counters.get('form_completions', 0)} forms, "
+        f"{counters.get('users_messages_counter', 0)} messages, "
+        f"{counters.get('staff_replies_counter', 0)} replies, "
+        f"first response {response_time(counters, 0.5)} "
+        f"(90%: {response_time(counters, 0.9)})"
     )
 
+
+def merge_counters(buckets: list[dict]) -> dict:
+    merged = {}
+    for bucket in buckets:
+        for name, value in bucket.items():
+            if name == "_id":
+                continue
+            if isinstance(value, dict):
+                nested = merged.setdefault(name, {})
+                for key, count in value.items():
+                    nested[key] = nested.get(key, 0) + count
+            else:
+                merged[name] = merged.get(name, 0) + value
+    return merged
+
+
+async def hotline_trends() -> str:
+    # read from the hourly and daily buckets, no raw events are scanned
+    now = utc_now()
+    hours = await statistics_counters.history(
+        "statistics_hourly", hour_of(now) - timedelta(hours=23)
+    )
+    today = day_of(now)
+    days = await statistics_counters.history(
+        "statistics_daily", today - timedelta(days=TREND_DAYS - 1)
+    )
+    days_by_date = {day["_id"]: day for day in days}
+
+    lines = [
+        f"<b>{date:%a %d %b}</b>: {trend_line(days_by_date.get(date, {}))}"
+        for date in (today - timedelta(days=i) for i in range(TREND_DAYS))
+    ]
+    return (
+        "<b><u>Hotline Trends:</u></b>\n\n"
+        f"<b>Last 24 hours</b>: {trend_line(merge_counters(hours))}.\n\n"
+        f"<b>Last {TREND_DAYS} days</b>: {trend_line(merge_counters(days))}.\n\n"
+        + ".\n".join(lines)
+        + "\n\n<i>Times are in UTC, first response times are bucket bounds.</i>"
+    )
+
+
+async def trends_handler(callback_query: types.CallbackQuery):
+    trends_text = await trends_cache.get(hotline_trends)
+    back_button = types.InlineKeyboardButton("Go Back", "statistics")
     await callback_query.message.edit_text(
-        stats_report_text, reply_markup=back_keyboard()
+        trends_text, reply_markup=types.InlineKeyboardMarkup([[back_button]])
     )
 
 
-async def unban_button_handler(
-    callback_query: types.CallbackQuery, db_client: MongoClient
-):
-    banned_users_ids = db_client.masaBotDB.config.find_one({}, {"banned_users": 1})[
-        "banned_users"
-    ]
-    banned_users = db_client.masaBotDB.users.find({"_id": {"$in": banned_users_ids}})
-    banned_users = [user for user in banned_users]
+def ban_expiry(user: User) -> str:
+    expires_at = ban_list.expires_at(user.id)
+    return f" (until {expires_at:%Y-%m-%d %H:%M} UTC)" if expires_at else ""
 
-    if banned_users:
-        banned_users_text = "<b><u>Banned Users</u></b>:\n\n" + "\n\n".join(
-            [
-                f"<b>#{user['serial_number']}{' ('+user['custom_name']+')' if user['custom_name'] else ''}</b>\t/unban_{user['serial_number']}"
-                for user in banned_users
-            ]
-        )
+
+async def users_page(
+    db_client: AsyncMongoClient, list_name: str, direction: str, serial_number: int
+) -> tuple[str, types.InlineKeyboardMarkup]:
+    if list_name == "banned":
+        query = {"_id": {"$in": ban_list.ids()}}
     else:
-        banned_users_text = "<b>No Banned Users</b>"
+        query = {"filled_form": list_name == "filled"}
 
-    await callback_query.message.edit_text(
-        banned_users_text, reply_markup=back_keyboard()
+    # keyset pagination, one more user than needed tells if there is another page
+    if direction == "next":
+        query["serial_number"] = {"$gt": serial_number}
+        sort_order = 1
+    else:
+        query["serial_number"] = {"$lt": serial_number}
+        sort_order = -1
+
+    docs = (
+        await db_client.masaBotDB.users.find(query, User.projection(PAGE_FIELDS))
+        .sort("serial_number", sort_order)
+        .limit(USERS_PAGE_SIZE + 1)
+        .to_list()
+    )
+    users = [User.from_doc(doc, PAGE_FIELDS) for doc in docs]
+    has_more = len(users) > USERS_PAGE_SIZE
+    users = users[:USERS_PAGE_SIZE]
+    if direction == "next":
+        has_previous, has_next = serial_number > 0, has_more
+    else:
+        users.reverse()
+        has_previous, has_next = has_more, True
+
+    if list_name == "banned":
+        lines = [
+            f"{user.display_name}{ban_expiry(user)}\t/unban_{user.serial_number}"
+            for user in users
+        ]
+        page_text = "\n\n".join(lines)
+    else:
+        lines = [user.display_name for user in users]
+        page_text = ".\n".join(lines)
+
+    navigation_buttons = []
+    if users and has_previous:
+        navigation_buttons.append(
+            types.InlineKeyboardButton(
+                "⬅️ Previous",
+                f"users_page:{list_name}:previous:{users[0].serial_number}",
+            )
+        )
+    if users and has_next:
+        navigation_buttons.append(
+            types.InlineKeyboardButton(
+                "Next ➡️", f"users_page:{list_name}:next:{users[-1].serial_number}"
+            )
+        )
+
+    keyboard = types.InlineKeyboardMarkup(
+        [navigation_buttons, [types.InlineKeyboardButton("Go Back", "back")]]
+    )
+    title = USER_LISTS[list_name]
+    return f"<b><u>{title}</u></b>:\n\n{page_text or 'No users.'}", keyboard
+
+
+async def users_page_handler(
+    callback_query: types.CallbackQuery, db_client: AsyncMongoClient
+):
+    _, list_name, direction, serial_number = callback_query.data.split(":")
+    if list_name not in USER_LISTS or direction not in ("next", "previous"):
+        return
+
+    page_text, keyboard = await users_page(
+        db_client, list_name, direction, int(serial_number)
     )
+    await callback_query.message.edit_text(page_text, reply_markup=keyboard)
+
+
+async def unban_button_handler(
+    callback_query: types.CallbackQuery, db_client: AsyncMongoClient
+):
+    page_text, keyboard = await users_page(db_client, "banned", "next", 0)
+    await callback_query.message.edit_text(page_text, reply_markup=keyboard)
 
 
-async def unban_user_handler(message: types.Message, db_client: MongoClient):
+async def unban_user_handler(message: types.Message, db_client: AsyncMongoClient):
     serial_number = message.text.split("/unban_")[-1]
     if not serial_number.isnumeric():
-        await message.reply(
-            "Please use the unban command like `/unban_serialnumber` e.g `/unban_1`"
+        await outbox.reply(
+            message,
+            "Please use the unban command like `/unban_serialnumber` e.g `/unban_1`",
         )
         return
 
-    banned_users_ids = db_client.masaBotDB.config.find_one({}, {"banned_users": 1})[
-        "banned_users"
-    ]
-    user_to_unban = db_client.masaBotDB.users.find_one(
-        {"serial_number": int(serial_number)}
-    )
+    user_to_unban = await user_cache.by_serial(int(serial_number))
 
-    if not user_to_unban or user_to_unban["_id"] not in banned_users_ids:
-        await message.reply(
-            f"Ther is no banned user with the serial number: {serial_number}"
+    if not user_to_unban or not ban_list.is_banned(user_to_unban.id):
+        await outbox.reply(
+            message, f"Ther is no banned user with the serial number: {serial_number}"
         )
         return
 
-    db_client.masaBotDB.config.update_one(
-        {}, {"$pull": {"banned_users": user_to_unban["_id"]}}
-    )
+    await ban_list.unban(user_to_unban.id)
 
-    await message.reply(f"User #{serial_number} has been unbanned succefully ✅")
+    await outbox.reply(
+        message, f"User #{serial_number} has been unbanned succefully ✅"
+    )
 
 
 async def back_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, context: UpdateContext
 ):
     admin = callback_query.from_user
-    await client.stop_listening(chat_id=admin.id)
-    await client.stop_listening(
-        listener_type=enums.ListenerTypes.CALLBACK_QUERY, chat_id=admin.id
-    )
+    await conversations.clear(admin.id, admin.id)
 
+    config = await context.config()
     settings = (
         "<b><u>Bot Current Settings</u></b>:\n\n"
-        f"{await current_settings(client, db_client)}"
+        f"{await current_settings(client, config)}"
     )
 
-    super_admin_id = db_client.masaBotDB.config.find_one({}, {"super_admin_id"})[
-        "super_admin_id"
-    ]
-    is_super_admin = admin.id == super_admin_id
+    is_super_admin = admin.id == config.super_admin_id
     await callback_query.message.edit_text(
         settings, reply_markup=admin_keyboard(is_super_admin)
     )
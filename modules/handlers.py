@@ -0,0 +1,234 @@
+from pymongo import AsyncMongoClient
+from pyrogram import Client, filters
+
+from modules import admins, staff, users
+from utils.context import UpdateContext
+from utils.flood import flood_guard
+from utils.fsm import in_state
+from utils.membership import ga_members
+from utils.metrics import labelled
+from utils.router import callback_router
+from utils.trace import trace_recorder
+
+
+def register_handlers(client: Client, db_client: AsyncMongoClient) -> None:
+    def context(client, update) -> UpdateContext:
+        return UpdateContext.of(update, client, db_client)
+
+    # Filters
+    async def is_admin(_, client, update):
+        return await context(client, update).is_admin()
+
+    admin_chat_filter = filters.create(is_admin)
+
+    async def is_user(_, client, update):
+        return await context(client, update).is_user()
+
+    bot_user_filter = filters.create(is_user)
+
+    async def is_staff_chat(_, client, update):
+        return await context(client, update).in_staff_chat()
+
+    staff_chat_filter = filters.create(is_staff_chat)
+
+    # Traffic recording for bench/replay.py, runs before the other handlers,
+    # the flood limiter included, so traces keep the spam it drops
+    if trace_recorder.enabled:
+
+        @client.on_message(group=-3)
+        @labelled("trace_recorder.record")
+        async def _(client, message):
+            await trace_recorder.record(message)
+
+        @client.on_callback_query(group=-3)
+        @labelled("trace_recorder.record")
+        async def _(client, callback_query):
+            await trace_recorder.record(callback_query)
+
+    # Flood limiter, runs before the filters that read the database
+    @client.on_message(group=-2)
+    @labelled("flood_guard.check")
+    async def _(client, message):
+        await flood_guard.check(client, message)
+
+    @client.on_callback_query(group=-2)
+    @labelled("flood_guard.check")
+    async def _(client, callback_query):
+        await flood_guard.check(client, callback_query)
+
+    # Callback queries, the role of the caller is resolved once and the action
+    # in the callback data picks the handler
+    @client.on_callback_query()
+    @labelled(None)
+    async def _(client, callback_query):
+        update_context = context(client, callback_query)
+        await callback_router.dispatch(
+            await update_context.role(),
+            client,
+            callback_query,
+            db_client=db_client,
+            context=update_context,
+        )
+
+    callback_router.add("user", "filled_form", users.filled_form_handler)
+    callback_router.add("user", "refill_form", users.refill_form_handler)
+    callback_router.add("user", "contact_staff", users.contact_staff_handler)
+    callback_router.add("user", "user_back", users.back_handler)
+    callback_router.add(
+        "user", "confirm", users.contact_staff_confirm_handler, answers=True
+    )
+
+    callback_router.add(
+        "staff", "confirm_reply", staff.confirm_reply_handler, answers=True
+    )
+    callback_router.add(
+        "staff", "confirm_send", staff.confirm_send_handler, answers=True
+    )
+    callback_router.add(
+        "staff", "confirm_assign", staff.confirm_assign_handler, answers=True
+    )
+    callback_router.add("staff", "cancel", staff.cancel_handler, answers=True)
+
+    callback_router.add("admin", "set_staff_chat", admins.set_staff_chat_handler)
+    callback_router.add(
+        "admin", "set_assessment_form_link", admins.set_assesment_form_link_handler
+    )
+    callback_router.add("admin", "set_ga_chat", admins.set_ga_chat_handler)
+    callback_router.add("admin", "broadcast", admins.broadcast_handler)
+    callback_router.add("admin", "ban_user", admins.ban_user_handler)
+    callback_router.add("admin", "unban_user", admins.unban_button_handler)
+    callback_router.add("admin", "add_admin", admins.add_admin_handler)
+    callback_router.add("admin", "manage_admins", admins.manage_admins_handler)
+    callback_router.add("admin", "statistics", admins.statistics_handler)
+    callback_router.add("admin", "trends", admins.trends_handler)
+    callback_router.add("admin", "users_page", admins.users_page_handler)
+    callback_router.add("admin", "back", admins.back_handler)
+    callback_router.add(
+        "admin",
+        "confirm_assessment_form_set",
+        admins.confirm_form_link_handler,
+        answers=True,
+    )
+    callback_router.add(
+        "admin", "confirm_broadcast", admins.confirm_broadcast_handler, answers=True
+    )
+    callback_router.add(
+        "admin",
+        "confirm_super_admin_transfer",
+        admins.confirm_super_admin_transfer_handler,
+        answers=True,
+    )
+
+    # General assembly chat membership changes (the bot must be a GA chat admin)
+    @client.on_chat_member_updated()
+    @labelled("ga_members.on_member_updated")
+    async def _(client, chat_member_updated):
+        ga_members.on_member_updated(chat_member_updated)
+
+    # User-Bot interaction
+    @client.on_message(bot_user_filter & filters.command("start"))
+    @labelled("users.start_handler")
+    async def _(client, message):
+        await users.start_handler(client, message, db_client, context(client, message))
+
+    @client.on_message(filters.private & bot_user_filter & in_state("contact_staff"))
+    @labelled("users.contact_staff_message_handler")
+    async def _(client, message):
+        await users.contact_staff_message_handler(client, message)
+
+    @client.on_message(filters.private & bot_user_filter & filters.text)
+    @labelled("users.text_handler")
+    async def _(client, message):
+        await users.text_handler(message)
+
+    # Staff-Bot interaction
+    @client.on_message(staff_chat_filter & filters.command("reply"))
+    @labelled("staff.reply_handler")
+    async def _(client, message):
+        await staff.reply_handler(client, message, db_client)
+
+    @client.on_message(staff_chat_filter & filters.command("send"))
+    @labelled("staff.send_handler")
+    async def _(client, message):
+        await staff.send_handler(client, message, db_client)
+
+    @client.on_message(staff_chat_filter & filters.command("assign"))
+    @labelled("staff.assign_name_handler")
+    async def _(client, message):
+        await staff.assign_name_handler(client, message, db_client)
+
+    @client.on_message(staff_chat_filter & filters.command("help"))
+    @labelled("staff.help_handler")
+    async def _(client, message):
+        await staff.help_handler(message)
+
+    @client.on_message(staff_chat_filter & in_state("send_message"))
+    @labelled("staff.send_message_handler")
+    async def _(client, message):
+        await staff.send_message_handler(client, message)
+
+    # Admin-Bot interaction
+    @client.on_message(admin_chat_filter & filters.command("start") & filters.private)
+    @labelled("admins.start_handler")
+    async def _(client, message):
+        await admins.start_handler(client, message, context(client, message))
+
+    @client.on_message(
+        admin_chat_filter & filters.private & filters.regex(r"^/unban_\d+$")
+    )
+    @labelled("admins.unban_user_handler")
+    async def _(client, message):
+        await admins.unban_user_handler(message, db_client)
+
+    @client.on_message(
+        admin_chat_filter & filters.private & filters.regex(r"^/remove_admin_\d+$")
+    )
+    @labelled("admins.remove_admin_handler")
+    async def _(client, message):
+        await admins.remove_admin_handler(message, db_client)
+
+    @client.on_message(
+        admin_chat_filter
+        & filters.private
+        & filters.regex(r"^/transfer_super_admin_\d+$")
+    )
+    @labelled("admins.transfer_super_admin_handler")
+    async def _(client, message):
+        await admins.transfer_super_admin_handler(client, message, db_client)
+
+    # Admin panel conversations, after the commands so they can be interrupted
+    admin_private_filter = admin_chat_filter & filters.private
+
+    @client.on_message(admin_private_filter & in_state("set_staff_chat"))
+    @labelled("admins.staff_chat_message_handler")
+    async def _(client, message):
+        await admins.staff_chat_message_handler(
+            client, message, context(client, message)
+        )
+
+    @client.on_message(
+        admin_private_filter & filters.text & in_state("set_assessment_form_link")
+    )
+    @labelled("admins.form_link_message_handler")
+    async def _(client, message):
+        await admins.form_link_message_handler(client, message)
+
+    @client.on_message(admin_private_filter & in_state("set_ga_chat"))
+    @labelled("admins.ga_chat_message_handler")
+    async def _(client, message):
+        await admins.ga_chat_message_handler(client, message, context(client, message))
+
+    @client.on_message(admin_private_filter & in_state("broadcast"))
+    @labelled("admins.broadcast_message_handler")
+    async def _(client, message):
+        await admins.broadcast_message_handler(client, message, db_client)
+
+    @client.on_message(admin_private_filter & filters.text & in_state("ban_user"))
+    @labelled("admins.ban_user_message_handler")
+    async def _(client, message):
+        await admins.ban_user_message_handler(message, db_client)
+
+    @client.on_message(admin_private_filter & filters.text & in_state("add_admin"))
+    @labelled("admins.add_admin_message_handler")
+    async def _(client, message):
+        await admins.add_admin_message_handler(client, message)
@@ -1,211 +1,267 @@
-import asyncio
 import re
 
-from pymongo import MongoClient
-from pyrogram import Client, enums, errors, filters, types
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError
+from pyrogram import Client, errors, types
 
+from models.user import User
+from utils.fsm import callback_nonce, conversations, utc_now
+from utils.indexes import CASE_INSENSITIVE
+from utils.outbox import outbox
+from utils.statistics import statistics_counters
+from utils.user_cache import user_cache
 
-async def reply_handler(client: Client, message: types.Message, db_client: MongoClient):
+CANCEL_MESSAGES = {
+    "reply_confirm": "Reply cancelled ✅",
+    "send_confirm": "Sending Cancelled ✅",
+    "assign_confirm": "Name assignment cancelled ✅",
+}
+
+
+async def record_first_response(user_in_db: User) -> None:
+    # only the first staff message since the user started waiting counts
+    if user_in_db.awaiting_reply_since:
+        waited = utc_now() - user_in_db.awaiting_reply_since
+        statistics_counters.first_response(waited.total_seconds())
+        await user_cache.update(user_in_db.id, {"awaiting_reply_since": None})
+
+
+async def reply_handler(
+    client: Client, message: types.Message, db_client: AsyncMongoClient
+):
     bot_username = client.me.username
     cleaned_text = message.text.replace(f"@{bot_username}", "")
     pattern = r"(?s)/reply (\d+)\s+(.+)"
     text_match = re.match(pattern, cleaned_text)
     if not text_match:
-        return await message.reply(
+        return await outbox.reply(
+            message,
             "Please use the reply command like this:\n"
             "/reply <i>serial_number</i> <i>message</i>\n\n"
             "For example:\n"
             "/reply 1 مرحباً، يمكنك التواصل مع اختصاصي على الرقم التالي 01xxxxxxx\n\n"
-            'this will send:\n"<b>مرحباً، يمكنك التواصل مع اختصاصي على الرقم التالي 01xxxxxxx</b>"\n to the user with serial number <b>1</b>.'
+            'this will send:\n"<b>مرحباً، يمكنك التواصل مع اختصاصي على الرقم التالي 01xxxxxxx</b>"\n to the user with serial number <b>1</b>.',
         )
 
     serial_number, reply_text = text_match.groups()
-    user_in_db = db_client.masaBotDB.users.find_one(
-        {"serial_number": int(serial_number)}
-    )
+    user_in_db = await user_cache.by_serial(int(serial_number))
 
     if not user_in_db:
-        return await message.reply(
-            f"Sorry, There is no user with the serial number: {serial_number}"
+        return await outbox.reply(
+            message, f"Sorry, There is no user with the serial number: {serial_number}"
         )
 
+    nonce = await conversations.set(
+        message.chat.id,
+        message.from_user.id,
+        "reply_confirm",
+        user_id=user_in_db.id,
+        reply_text=reply_text,
+    )
+
     confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_reply"
+        "Confirm ✅", callback_data=f"confirm_reply:{nonce}"
     )
     cancel_button = types.InlineKeyboardButton(
-        "Cancel ❌", callback_data="cancel_reply"
+        "Cancel ❌", callback_data=f"cancel:{nonce}"
     )
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
-    user_name = f"<b>#{user_in_db['serial_number']}{' ('+user_in_db['custom_name']+')' if user_in_db['custom_name'] else ''}</b>"
+    user_name = user_in_db.display_name
 
-    await message.reply(
+    await outbox.reply(
+        message,
         "Are you sure you want to send:\n"
         f'"<b>{reply_text}</b>"\n\n'
         f"To the user {user_name}?",
         reply_markup=options_keyboard,
     )
 
-    callback_answer = await client.listen(
-        filters=filters.regex(r"^confirm_reply$|^cancel_reply$"),
-        chat_id=message.chat.id,
-        user_id=message.from_user.id,
-        listener_type=enums.ListenerTypes.CALLBACK_QUERY,
+
+async def confirm_reply_handler(
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
+):
+    conversation = await conversations.pop(
+        callback_query.message.chat.id,
+        callback_query.from_user.id,
+        callback_nonce(callback_query.data),
+        "reply_confirm",
     )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
+
+    user_in_db = await user_cache.get(conversation["data"]["user_id"])
+    if not user_in_db:
+        return
 
-    if callback_answer.data == "confirm_reply":
-        try:
-            await client.send_message(
-                user_in_db["_id"], "<b>لقد استلمت رداً من فريق MASA:</b>"
-            )
-            await client.send_message(user_in_db["_id"], reply_text)
-        except errors.UserIsBlocked:
-            print(
-                f"Bot wasn't able to send message to user {user_in_db['_id']}, it says: {e}"
-            )
-            return await callback_answer.message.edit_text(
-                f"""
-                    Bot wasn't able to reply to the user {user_name}, User Blocked the Bot.
-                """
-            )
-        except Exception as e:
-            print(
-                f"Bot wasn't able to send the message to user {user_in_db['_id']}, it says: {e}"
-            )
-            return await callback_answer.message.edit_text(
-                f"Failed to send the message to {user_name}.\n\n"
-                f"Show this error message to the bot developer:\n{e}"
-            )
-        else:
-            db_client.masaBotDB.statistics.update_one(
-                {}, {"$inc": {"staff_replies_counter": 1}}
-            )
-            return await callback_answer.message.edit_text(
-                f"""
-                    Reply sent to the user {user_name} succefully ✅
-                """
-            )
+    user_name = user_in_db.display_name
 
+    try:
+        await outbox.send_message(
+            client, user_in_db.id, "<b>لقد استلمت رداً من فريق MASA:</b>"
+        )
+        await outbox.send_message(
+            client, user_in_db.id, conversation["data"]["reply_text"]
+        )
+    except errors.UserIsBlocked as e:
+        print(f"Bot wasn't able to send message to user {user_in_db.id}, it says: {e}")
+        return await callback_query.message.edit_text(
+            f"""
+                Bot wasn't able to reply to the user {user_name}, User Blocked the Bot.
+            """
+        )
+    except Exception as e:
+        print(
+            f"Bot wasn't able to send the message to user {user_in_db.id}, it says: {e}"
+        )
+        return await callback_query.message.edit_text(
+            f"Failed to send the message to {user_name}.\n\n"
+            f"Show this error message to the bot developer:\n{e}"
+        )
     else:
-        return await callback_answer.message.edit_text("Reply cancelled ✅")
+        statistics_counters.inc("staff_replies_counter")
+        await record_first_response(user_in_db)
+        return await callback_query.message.edit_text(
+            f"""
+                Reply sent to the user {user_name} succefully ✅
+            """
+        )
 
 
-async def send_handler(client: Client, message: types.Message, db_client: MongoClient):
+async def send_handler(
+    client: Client, message: types.Message, db_client: AsyncMongoClient
+):
     bot_username = client.me.username
     cleaned_text = message.text.replace(f"@{bot_username}", "")
     pattern = r"(?s)/send (\d+)"
     text_match = re.match(pattern, cleaned_text)
     if not text_match:
-        return await message.reply(
+        return await outbox.reply(
+            message,
             "Please use the send command like this:\n"
             "/send <i>serial_number</i>\n\n"
             "For example:\n"
-            "/send 1"
+            "/send 1",
         )
 
     # extract serial number
     serial_number = text_match.groups()[0]
-    user_in_db = db_client.masaBotDB.users.find_one(
-        {"serial_number": int(serial_number)}
-    )
+    user_in_db = await user_cache.by_serial(int(serial_number))
 
     if not user_in_db:
-        return await message.reply(
-            f"Sorry, There is no user with the serial number: {serial_number}"
+        return await outbox.reply(
+            message, f"Sorry, There is no user with the serial number: {serial_number}"
         )
 
-    user_name = f"<b>#{user_in_db['serial_number']}{' ('+user_in_db['custom_name']+')' if user_in_db['custom_name'] else ''}</b>"
+    user_name = user_in_db.display_name
 
-    request_message = await message.reply(
-        f"Please reply to <b>THIS MESSAGE</b> with the message to send to user {user_name} (your message can contain media and files with or without caption) or reply with `cancel`"
+    request_message = await outbox.reply(
+        message,
+        f"Please reply to <b>THIS MESSAGE</b> with the message to send to user {user_name} (your message can contain media and files with or without caption) or reply with `cancel`",
     )
 
-    def is_reply_to_message(_, __, m):
-        return m.reply_to_message_id == request_message.id
+    await conversations.set(
+        message.chat.id,
+        message.from_user.id,
+        "send_message",
+        user_id=user_in_db.id,
+        user_name=user_name,
+        request_message_id=request_message.id,
+    )
 
-    reply_to_filter = filters.create(is_reply_to_message)
 
-    try:
-        message_to_user = await client.listen(
-            chat_id=message.chat.id,
-            user_id=message.from_user.id,
-            filters=reply_to_filter,
-        )
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
-    if not message_to_user:
-        return
+async def send_message_handler(client: Client, message: types.Message):
+    conversation = message.conversation
+
+    # only replies to the request message are sent to the user
+    if message.reply_to_message_id != conversation["data"]["request_message_id"]:
+        return message.continue_propagation()
 
-    if message_to_user.text and message_to_user.text.lower() == "cancel":
-        return await message_to_user.reply("Sending Cancelled ✅")
+    if message.text and message.text.lower() == "cancel":
+        await conversations.clear(message.chat.id, message.from_user.id)
+        return await outbox.reply(message, "Sending Cancelled ✅")
+
+    sample_message = await outbox.copy(message, message.chat.id)
+    nonce = await conversations.set(
+        message.chat.id,
+        message.from_user.id,
+        "send_confirm",
+        user_id=conversation["data"]["user_id"],
+        sample_message_id=sample_message.id,
+    )
 
     confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_send"
+        "Confirm ✅", callback_data=f"confirm_send:{nonce}"
+    )
+    cancel_button = types.InlineKeyboardButton(
+        "Cancel ❌", callback_data=f"cancel:{nonce}"
     )
-    cancel_button = types.InlineKeyboardButton("Cancel ❌", callback_data="cancel_send")
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
-    sample_message = await message_to_user.copy(message.chat.id)
-    await sample_message.reply(
-        f"Are you sure you want to send this message to user {user_name}?",
+    await outbox.reply(
+        sample_message,
+        f"Are you sure you want to send this message to user {conversation['data']['user_name']}?",
         reply_markup=options_keyboard,
     )
 
-    try:
-        callback_answer = await client.listen(
-            filters=filters.regex(r"^confirm_send$|^cancel_send$"),
-            chat_id=message.chat.id,
-            user_id=message.from_user.id,
-            listener_type=enums.ListenerTypes.CALLBACK_QUERY,
-        )
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
 
-    if not callback_answer:
+async def confirm_send_handler(
+    client: Client, callback_query: types.CallbackQuery, db_client: AsyncMongoClient
+):
+    conversation = await conversations.pop(
+        callback_query.message.chat.id,
+        callback_query.from_user.id,
+        callback_nonce(callback_query.data),
+        "send_confirm",
+    )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
+
+    user_in_db = await user_cache.get(conversation["data"]["user_id"])
+    if not user_in_db:
         return
 
-    if callback_answer.data == "cancel_send":
-        return await callback_answer.message.edit_text("Sending Cancelled ✅")
-
-    if callback_answer.data == "confirm_send":
-        try:
-            await client.send_message(
-                user_in_db["_id"], "<b>لقد استلمت رسالة من فريق MASA:</b>"
-            )
-            await sample_message.copy(user_in_db["_id"])
-        except errors.UserIsBlocked:
-            print(
-                f"Bot wasn't able to send message to user {user_in_db['_id']}, it says: {e}"
-            )
-            return await callback_answer.message.edit_text(
-                f"""
-                    Bot wasn't able to reply to the user {user_name}, User Blocked the Bot.
-                """
-            )
-        except Exception as e:
-            print(
-                f"Bot wasn't able to send the message to user {user_in_db['_id']}, it says: {e}"
-            )
-            return await callback_answer.message.edit_text(
-                f"Failed to send the message to {user_name}.\n\n"
-                f"Show this error message to the bot developer:\n{e}"
-            )
-        else:
-            db_client.masaBotDB.statistics.update_one(
-                {}, {"$inc": {"staff_replies_counter": 1}}
-            )
-            return await callback_answer.message.edit_text(
-                f"""
-                    Message sent to the user {user_name} succefully ✅
-                """
-            )
+    user_name = user_in_db.display_name
 
+    try:
+        await outbox.send_message(
+            client, user_in_db.id, "<b>لقد استلمت رسالة من فريق MASA:</b>"
+        )
+        await outbox.copy_message(
+            client,
+            user_in_db.id,
+            callback_query.message.chat.id,
+            conversation["data"]["sample_message_id"],
+        )
+    except errors.UserIsBlocked as e:
+        print(f"Bot wasn't able to send message to user {user_in_db.id}, it says: {e}")
+        return await callback_query.message.edit_text(
+            f"""
+                Bot wasn't able to reply to the user {user_name}, User Blocked the Bot.
+            """
+        )
+    except Exception as e:
+        print(
+            f"Bot wasn't able to send the message to user {user_in_db.id}, it says: {e}"
+        )
+        return await callback_query.message.edit_text(
+            f"Failed to send the message to {user_name}.\n\n"
+            f"Show this error message to the bot developer:\n{e}"
+        )
     else:
-        return await callback_answer.message.edit_text("Message cancelled ✅")
+        statistics_counters.inc("staff_replies_counter")
+        await record_first_response(user_in_db)
+        return await callback_query.message.edit_text(
+            f"""
+                Message sent to the user {user_name} succefully ✅
+            """
+        )
 
 
 async def assign_name_handler(
-    client: Client, message: types.Message, db_client: MongoClient
+    client: Client, message: types.Message, db_client: AsyncMongoClient
 ):
     bot_username = client.me.username
     cleaned_text = message.text.replace(f"@{bot_username}", "")
@@ -213,73 +269,108 @@ async def assign_name_handler(
     pattern = r"/assign (\d+) (.+)"
     text_match = re.match(pattern, cleaned_text)
     if not text_match:
-        return await message.reply(
+        return await outbox.reply(
+            message,
             "Please use the assign command like this:\n"
             "/assign <i>serial_number</i> <i>name</i>\n\n"
             "For example:\n"
             "/assign 1 PTSD + OCD\n"
-            "this will assign the name <b>PTSD + OCD</b> to the user with the serial number 1."
+            "this will assign the name <b>PTSD + OCD</b> to the user with the serial number 1.",
         )
 
     serial_number, custom_name = text_match.groups()
-    user_in_db = db_client.masaBotDB.users.find_one(
-        {"serial_number": int(serial_number)}
-    )
+    user_in_db = await user_cache.by_serial(int(serial_number))
 
     if not user_in_db:
-        return await message.reply(
-            f"Sorry, There is no user with the serial number: {serial_number}"
+        return await outbox.reply(
+            message, f"Sorry, There is no user with the serial number: {serial_number}"
         )
 
-    name_used = db_client.masaBotDB.users.find_one({"custom_name": custom_name})
+    name_used = await db_client.masaBotDB.users.find_one(
+        {"custom_name": {"$eq": custom_name, "$type": "string"}},
+        collation=CASE_INSENSITIVE,
+    )
 
     if name_used:
-        return await message.reply(
-            f"Sorry, There is already a user with the name: {custom_name}"
+        return await outbox.reply(
+            message, f"Sorry, There is already a user with the name: {custom_name}"
         )
 
+    nonce = await conversations.set(
+        message.chat.id,
+        message.from_user.id,
+        "assign_confirm",
+        user_id=user_in_db.id,
+        serial_number=serial_number,
+        custom_name=custom_name,
+    )
+
     confirm_button = types.InlineKeyboardButton(
-        "Confirm ✅", callback_data="confirm_assign"
+        "Confirm ✅", callback_data=f"confirm_assign:{nonce}"
     )
     cancel_button = types.InlineKeyboardButton(
-        "Cancel ❌", callback_data="cancel_assign"
+        "Cancel ❌", callback_data=f"cancel:{nonce}"
     )
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
-    user_name = f"<b>#{user_in_db['serial_number']}{' (Currently ' + user_in_db['custom_name']+')' if user_in_db['custom_name'] else ''}</b>"
+    user_name = f"<b>#{user_in_db.serial_number}{' (Currently ' + user_in_db.custom_name+')' if user_in_db.custom_name else ''}</b>"
 
-    await message.reply(
+    await outbox.reply(
+        message,
         "Are you sure you want to assing the name: "
         f'"<b>{custom_name}</b>" '
         f"To the user {user_name}?",
         reply_markup=options_keyboard,
     )
 
-    while True:
-        callback_answer = await client.listen(
-            filters=filters.regex(r"^confirm_assign$|^cancel_assign$"),
-            chat_id=message.chat.id,
-            user_id=message.from_user.id,
-            listener_type=enums.ListenerTypes.CALLBACK_QUERY,
+
+async def confirm_assign_handler(
+    callback_query: types.CallbackQuery, db_client: AsyncMongoClient
+):
+    conversation = await conversations.pop(
+        callback_query.message.chat.id,
+        callback_query.from_user.id,
+        callback_nonce(callback_query.data),
+        "assign_confirm",
+    )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
+
+    serial_number = conversation["data"]["serial_number"]
+    custom_name = conversation["data"]["custom_name"]
+    try:
+        await user_cache.update(
+            conversation["data"]["user_id"], {"custom_name": custom_name}
+        )
+    except DuplicateKeyError:
+        # the name was assigned to another user while waiting for confirmation
+        return await callback_query.message.edit_text(
+            f"Sorry, There is already a user with the name: {custom_name}"
         )
+    return await callback_query.message.edit_text(
+        f"""
+            User #{serial_number} Has been assigned the name {custom_name} succefully ✅
+        """
+    )
+
+
+async def cancel_handler(callback_query: types.CallbackQuery):
+    conversation = await conversations.pop(
+        callback_query.message.chat.id,
+        callback_query.from_user.id,
+        callback_nonce(callback_query.data),
+    )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
 
-        if callback_answer and callback_answer.data == "confirm_assign":
-            db_client.masaBotDB.users.update_one(
-                {"_id": user_in_db["_id"]}, {"$set": {"custom_name": custom_name}}
-            )
-            return await callback_answer.message.edit_text(
-                f"""
-                    User #{serial_number} Has been assigned the name {custom_name} succefully ✅
-                """
-            )
-        else:
-            return await callback_answer.message.edit_text(
-                "Name assignment cancelled ✅"
-            )
+    await callback_query.message.edit_text(CANCEL_MESSAGES[conversation["state"]])
 
 
 async def help_handler(message: types.Message):
-    await message.reply(
+    await outbox.reply(
+        message,
         "<b><u>Bot Manual:</u></b>\n\n"
         "<b>Hotline workflow is as follow:</b>\n\n"
         "- A user who need help starts me and if he/she is a member of KMSA community I will give him the assessment form to fill else I will aoplogize politely.\n\n"
@@ -287,5 +378,5 @@ async def help_handler(message: types.Message):
         "- The user who filled the form can conact you at any time through me and you can reply to him with the /reply command.\n\n"
         "You can send messages that contain media or files to users with the /send command.\n\n"
         "- You can assign <b>custom names</b> to users, these names will not visible for them.\n\n"
-        "- More funcationalities are available for <b>bot admins</b>, (i.e, setting staff chat, setting assessment form link, banning/unbanning users, seeing bot statistics and adding/removing other admins)."
+        "- More funcationalities are available for <b>bot admins</b>, (i.e, setting staff chat, setting assessment form link, banning/unbanning users, seeing bot statistics and adding/removing other admins).",
     )
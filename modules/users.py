@@ -1,11 +1,20 @@
-import asyncio
+import html
 import os
 
-from pymongo import MongoClient
-from pyrogram import Client, enums, errors, filters, types
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError
+from pyrogram import Client, errors, types
 
 from models.user import User
-from utils.log import log
+from utils.context import UpdateContext
+from utils.counters import user_serials
+from utils.digest import staff_digest
+from utils.fsm import callback_nonce, conversations, utc_now
+from utils.log import ERROR, log
+from utils.membership import ga_members
+from utils.outbox import outbox
+from utils.statistics import statistics_counters
+from utils.user_cache import user_cache
 
 is_production = os.getenv("PRODUCTION", None)
 if not is_production or is_production == "0":
@@ -47,49 +56,60 @@ def back_keyboard():
 
 
 async def start_handler(
-    client: Client, message: types.Message, db_client: MongoClient
+    client: Client,
+    message: types.Message,
+    db_client: AsyncMongoClient,
+    context: UpdateContext,
 ) -> None:
     user = message.from_user
-    await client.stop_listening(chat_id=user.id)
-    await client.stop_listening(
-        listener_type=enums.ListenerTypes.CALLBACK_QUERY, chat_id=user.id
-    )
+    await conversations.clear(user.id, user.id)
 
-    config = db_client.masaBotDB.config.find_one({})
+    config = await context.config()
 
     # Bot is not configured yet
-    if not config or not config["assessment_form_link"] or not config["staff_chat_id"]:
-        return await message.reply("عذراً، البوت تحت الصيانة الرجاء المحاولة لاحقاً 😇.")
+    if not config or not config.assessment_form_link or not config.staff_chat_id:
+        return await outbox.reply(
+            message, "عذراً، البوت تحت الصيانة الرجاء المحاولة لاحقاً 😇."
+        )
 
     # general assembly chat membership check is required
-    if config["ga_chat_id"]:
+    if config.ga_chat_id:
         try:
-            await client.get_chat_member(config["ga_chat_id"], user.id)
-        except errors.UserNotParticipant:
-            await message.reply(
-                "عذراً ❌، هذه الخدمة متاحة حالياً لطلّاب كلية الطب جامعة الخرطوم، إذا كنت طالباً في كلية الطب جامعة الخرطوم الرجاء التأكد من أنّك تراسل البوت من خلال حسابك الموجود في مجموعة الجمعيِّة العمومية لرابطة طلاب كلية الطب جامعة الخرطوم على تيليجرام."
-            )
-            return
+            is_member = await ga_members.is_member(client, config.ga_chat_id, user.id)
         except (errors.ChannelIdInvalid, errors.ChatIdInvalid):
             await log(
-                "Please insure the bot is still in the general assembly group, it wans't able to check a user membership."
+                client,
+                "Please insure the bot is still in the general assembly group, it wans't able to check a user membership.",
             )
         except Exception as e:
             await log(client, str(e))
+        else:
+            if not is_member:
+                await outbox.reply(
+                    message,
+                    "عذراً ❌، هذه الخدمة متاحة حالياً لطلّاب كلية الطب جامعة الخرطوم، إذا كنت طالباً في كلية الطب جامعة الخرطوم الرجاء التأكد من أنّك تراسل البوت من خلال حسابك الموجود في مجموعة الجمعيِّة العمومية لرابطة طلاب كلية الطب جامعة الخرطوم على تيليجرام.",
+                )
+                return
 
-    user_in_db = db_client.masaBotDB.users.find_one({"_id": user.id})
+    user_in_db = await context.user()
 
     # user is starting the bot for the first time
     if not user_in_db:
-        user_serial = db_client.masaBotDB.users.count_documents({}) + 1
+        user_serial = await user_serials.next()
         new_user = User(id=user.id, serial_number=user_serial, filled_form=False)
-        db_client.masaBotDB.users.insert_one(new_user.as_dict())
+        try:
+            await user_cache.insert(new_user)
+        except DuplicateKeyError:
+            # a concurrent /start of the same user already registered him/her
+            return
+        statistics_counters.inc("new_users")
 
-        await message.reply(
+        await outbox.reply(
+            message,
             "أهلاً بك في بوت الخط الساخن الخاص ب MASA!\n"
             "إذا كنت تحتاج إلى المساعدة فنحن هنا دائماً لأجلك.\n\n"
             "الرجاء ملء الفورم التالي لمساعدتنا في معرفة ما تمرّ به وكيف يمكننا مساعدتك 😇\n"
-            f"{config["assessment_form_link"]}\n\n"
+            f"{config.assessment_form_link}\n\n"
             f"<b><u>your serial number is:</u></b> {user_serial}.\n\n\n"
             "نحيطكم علماً بأن هويتكم وجميع البيانات التي تقدمونها يتم التعامل بها بمجهولية تامة ولا يستطيع حتى العاملون في MASA معرفة هوية مقدمي الطلبات 👤.\n\n"
             "<b>تنويه: يمكنك التواصل مع فريق MASA بعد أن تقوم بملء الفورم.</b>",
@@ -98,64 +118,80 @@ async def start_handler(
         return
 
     # user has started the bot before, but didn't fill the form yet
-    elif not user_in_db["filled_form"]:
-        await message.reply(
+    elif not user_in_db.filled_form:
+        await outbox.reply(
+            message,
             "مرحباً, الرجاء ملء الفورم التالي لمساعدتنا في معرفة ما تمرّ به وكيف يمكننا مساعدتك 😇\n"
-            f"{config["assessment_form_link"]}\n\n"
-            f"<b><u>your serial number is:</u></b> {user_in_db["serial_number"]}.\n\n"
+            f"{config.assessment_form_link}\n\n"
+            f"<b><u>your serial number is:</u></b> {user_in_db.serial_number}.\n\n"
             "<b>تنويه: يمكنك التواصل مع فريق MASA، ولكن بعد أن تقوم بملء الفورم.<b/>",
             reply_markup=filled_form_keyboard(),
         )
         return
 
     # user filled the form before
-    await message.reply(
-        f"مرحباً المستخدم #<b>{user_in_db["serial_number"]}</b>!، نرجو أنك بخير 😇\n"
+    await outbox.reply(
+        message,
+        f"مرحباً المستخدم #<b>{user_in_db.serial_number}</b>!، نرجو أنك بخير 😇\n"
         "يمكنك دائماً التواصل بسرية مع فريق MASA على هذا الخط الساخن وسيجيبك أعضاء الفريق في أقرب وقت ممكن!",
         reply_markup=user_keyboard(),
     )
 
 
 async def filled_form_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client,
+    callback_query: types.CallbackQuery,
+    db_client: AsyncMongoClient,
+    context: UpdateContext,
 ):
-    user_in_db = db_client.masaBotDB.users.find_one(
-        {"_id": callback_query.from_user.id}
-    )
+    user_in_db = await context.user()
     if not user_in_db:
         return
 
     # ensure staff chat is configured
-    config = db_client.masaBotDB.config.find_one({})
-    if not config or not config["staff_chat_id"]:
+    config = await context.config()
+    if not config or not config.staff_chat_id:
         return callback_query.message.edit_text(
             "عذراً، البوت تحت الصيانة حاليا ❌.\n" "الرجاء المحاولة لاحقاً."
         )
 
-    user_name = f"<b>#{user_in_db['serial_number']}{' ('+user_in_db['custom_name']+')' if user_in_db['custom_name'] else ''}</b>"
+    user_name = user_in_db.display_name
 
     try:
         # inform staff chat that the user filled the form
-        await client.send_message(
-            config["staff_chat_id"],
-            f"""
+        if staff_digest.enabled:
+            staff_digest.add(
+                client,
+                config.staff_chat_id,
+                f"User {user_name} Says that he/she filled the form.",
+            )
+        else:
+            await outbox.send_message(
+                client,
+                config.staff_chat_id,
+                f"""
                 User {user_name} Says that he/she filled the form, please check and reply to him with the reply command.
             """,
-        )
+            )
     except Exception as e:
-        await log(client, f"Error sending message in staff chat {e}")
+        await log(client, f"Error sending message in staff chat {e}", level=ERROR)
 
         # tell the admins that the bot wasn't able to send messsages in staff chat
-        for admin_id in config["admins_list"]:
+        for admin_id in config.admins_list:
             try:
-                await client.send_message(
+                await outbox.send_message(
+                    client,
                     admin_id,
                     f"User {user_name} said he/she filled the form\n."
                     "Bot wasn't able to access the staff chat, please ensure that "
                     "the staff chat is set and that the bot is a member in the staff chat and has the permission to send messages there.",
                 )
             except Exception as e:
-                await log(client, f"Failed to message admin {admin_id}, it says: {e}")
+                await log(
+                    client,
+                    f"Failed to message admin {admin_id}, it says: {e}",
+                    level=ERROR,
+                )
 
     else:
         # the staff chat was notified succeffuly
@@ -165,23 +201,21 @@ async def filled_form_handler(
             reply_markup=user_keyboard(),
         )
 
-    db_client.masaBotDB.users.update_one(
-        {"_id": callback_query.from_user.id}, {"$set": {"filled_form": True}}
-    )
+    if not user_in_db.filled_form:
+        statistics_counters.inc("form_completions")
+    await user_cache.update(callback_query.from_user.id, {"filled_form": True})
 
 
 async def refill_form_handler(
-    callback_query: types.CallbackQuery, db_client: MongoClient
+    callback_query: types.CallbackQuery, context: UpdateContext
 ):
-    user_in_db = db_client.masaBotDB.users.find_one(
-        {"_id": callback_query.from_user.id}
-    )
+    user_in_db = await context.user()
     if not user_in_db:
         return
 
     # ensure staff chat is confiugred
-    config = db_client.masaBotDB.config.find_one({})
-    if not config or not config["assessment_form_link"]:
+    config = await context.config()
+    if not config or not config.assessment_form_link:
         return callback_query.message.edit_text(
             "عذراً، البوت تحت الصيانة حاليا ❌.\n" "الرجاء المحاولة لاحقاً."
         )
@@ -193,22 +227,22 @@ async def refill_form_handler(
     # send the form the user
     await callback_query.message.edit_text(
         "يمكن إعادة ملء الفورم على الرابط التالي:\n"
-        f"{config["assessment_form_link"]}\n\n"
-        f"your serial number is {user_in_db["serial_number"]}",
+        f"{config.assessment_form_link}\n\n"
+        f"your serial number is {user_in_db.serial_number}",
         reply_markup=filled_form_keyboard(refill=True),
     )
 
 
 async def contact_staff_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    callback_query: types.CallbackQuery, context: UpdateContext
 ):
-    user_in_db = db_client.masaBotDB.users.find_one({})
+    user_in_db = await context.user()
     if not user_in_db:
         return
 
     # ensure the staff chat is configured
-    config = db_client.masaBotDB.config.find_one({})
-    if not config or not config["staff_chat_id"]:
+    config = await context.config()
+    if not config or not config.staff_chat_id:
         return await callback_query.message.edit_text(
             "عذراً، البوت تحت الصيانة حاليا ❌.\n" "الرجاء المحاولة لاحقاً.",
             reply_markup=back_keyboard(),
@@ -220,66 +254,94 @@ async def contact_staff_handler(
         "الرجاء إرسال رسالتك وسيتم تحويلها إلى فريق MASA بسرية 😇",
         reply_markup=back_keyboard(),
     )
-    try:
-        message_to_staff = await client.listen(chat_id=user.id, user_id=user.id)
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
-    if not message_to_staff:
-        return
+    await conversations.set(user.id, user.id, "contact_staff")
+
+
+async def contact_staff_message_handler(client: Client, message: types.Message):
+    user = message.from_user
+    nonce = await conversations.set(
+        user.id,
+        user.id,
+        "contact_staff_confirm",
+        message_id=message.id,
+        text=message.text,
+    )
 
-    confirm_button = types.InlineKeyboardButton("تأكيد ✅", callback_data="confirm")
+    confirm_button = types.InlineKeyboardButton(
+        "تأكيد ✅", callback_data=f"confirm:{nonce}"
+    )
     cancel_button = types.InlineKeyboardButton("إلغاء ❌", callback_data="user_back")
     options_keyboard = types.InlineKeyboardMarkup([[confirm_button], [cancel_button]])
 
-    await message_to_staff.copy(user.id)
-    await client.send_message(
+    await outbox.copy(message, user.id)
+    await outbox.send_message(
+        client,
         user.id,
         "الرجاء التأكيد بإنك ترغب بإرسال الرسالة السابقة إلى فريق MASA 😇",
         reply_markup=options_keyboard,
     )
 
-    try:
-        callback_answer = await client.listen(
-            filters=filters.regex(r"^confirm$|^user_back$"),
-            chat_id=user.id,
-            user_id=user.id,
-            listener_type=enums.ListenerTypes.CALLBACK_QUERY,
-        )
-    except (errors.ListenerStopped, asyncio.TimeoutError):
-        return
 
-    if not callback_answer:
-        return
+async def contact_staff_confirm_handler(
+    client: Client,
+    callback_query: types.CallbackQuery,
+    db_client: AsyncMongoClient,
+    context: UpdateContext,
+):
+    user = callback_query.from_user
+    conversation = await conversations.pop(
+        user.id, user.id, callback_nonce(callback_query.data), "contact_staff_confirm"
+    )
+    if not conversation:
+        return await callback_query.answer("This request has expired.")
+    await callback_query.answer()
 
-    user_in_db = db_client.masaBotDB.users.find_one({"_id": user.id})
+    user_in_db = await context.user()
     if not user_in_db:
         return
 
-    if callback_answer.data == "user_back":
-        return await back_handler(client, callback_answer, db_client)
+    config = await context.config()
 
-    user_name = f"<b>#{user_in_db['serial_number']}{' ('+user_in_db['custom_name']+')' if user_in_db['custom_name'] else ''}</b>"
+    user_name = user_in_db.display_name
 
+    message_text = conversation["data"].get("text")
     try:
-        await client.send_message(
-            config["staff_chat_id"],
-            f"<b>Hey MASA staff!, User {user_name} sended this message to you:</b>",
-        )
-        await message_to_staff.copy(config["staff_chat_id"])
-        await client.send_message(
-            config["staff_chat_id"], f"You can reply to him with the reply command!"
-        )
+        # short texts are coalesced, media is still copied on its own
+        if staff_digest.fits(message_text):
+            staff_digest.add(
+                client,
+                config.staff_chat_id,
+                f"<b>User {user_name} says:</b>\n{html.escape(message_text)}",
+            )
+        else:
+            await outbox.send_message(
+                client,
+                config.staff_chat_id,
+                f"<b>Hey MASA staff!, User {user_name} sended this message to you:</b>",
+            )
+            await outbox.copy_message(
+                client,
+                config.staff_chat_id,
+                user.id,
+                conversation["data"]["message_id"],
+            )
+            await outbox.send_message(
+                client,
+                config.staff_chat_id,
+                f"You can reply to him with the reply command!",
+            )
 
     except Exception as e:
         print(f"Bot wasn't able to send message in staff chat, it says: {e}")
-        callback_answer.message.edit_text(
+        callback_query.message.edit_text(
             "عذراً، البوت تحت الصيانة حاليا ❌.\n" "الرجاء المحاولة لاحقاً."
         )
     else:
-        db_client.masaBotDB.statistics.update_one(
-            {}, {"$inc": {"users_messages_counter": 1}}
-        )
-        await callback_answer.message.edit_text(
+        statistics_counters.inc("users_messages_counter")
+        # the staff's first response time is measured from here
+        if not user_in_db.awaiting_reply_since:
+            await user_cache.update(user_in_db.id, {"awaiting_reply_since": utc_now()})
+        await callback_query.message.edit_text(
             """
                 استلم أعضاء فريق MASA رسالتك، وسيتم الرد عليك في أقرب وقت ممكن ✅
             """,
@@ -290,41 +352,40 @@ async def contact_staff_handler(
 
 
 async def back_handler(
-    client: Client, callback_query: types.CallbackQuery, db_client: MongoClient
+    client: Client, callback_query: types.CallbackQuery, context: UpdateContext
 ):
     user = callback_query.from_user
-    await client.stop_listening(chat_id=user.id)
-    await client.stop_listening(
-        listener_type=enums.ListenerTypes.CALLBACK_QUERY, chat_id=user.id
-    )
+    await conversations.clear(user.id, user.id)
 
-    config = db_client.masaBotDB.config.find_one({})
+    config = await context.config()
 
     # Bot is not configured yet
-    if not config or not config["assessment_form_link"] or not config["staff_chat_id"]:
+    if not config or not config.assessment_form_link or not config.staff_chat_id:
         return
 
     # general assembly chat membership check is required
-    if config["ga_chat_id"]:
+    if config.ga_chat_id:
         try:
-            await client.get_chat_member(config["ga_chat_id"], user.id)
+            if not await ga_members.is_member(client, config.ga_chat_id, user.id):
+                return
         except Exception as e:
             return
 
-    user_in_db = db_client.masaBotDB.users.find_one({"_id": user.id})
+    user_in_db = await context.user()
 
-    if not user_in_db or not user_in_db["filled_form"]:
+    if not user_in_db or not user_in_db.filled_form:
         return
 
     await callback_query.message.edit_text(
-        f"مرحباً المستخدم <b>#{user_in_db["serial_number"]}</b>!، نرجو أنك بخير 😇\n"
+        f"مرحباً المستخدم <b>#{user_in_db.serial_number}</b>!، نرجو أنك بخير 😇\n"
         "يمكنك دائماً التواصل بسرية مع فريق MASA على هذا الخط الساخن وسيجيبك أعضاء الفريق في أقرب وقت ممكن!",
         reply_markup=user_keyboard(),
     )
 
 
 async def text_handler(message: types.Message):
-    await message.reply(
+    await outbox.reply(
+        message,
         "الرجاء التعامل مع البوت باستخدام الأزرار أسفله 😇👇",
         reply_markup=user_keyboard(),
     )
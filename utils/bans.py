@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime
+
+from pymongo.asynchronous.collection import AsyncCollection
+
+from utils.change_streams import watch_forever
+from utils.config_cache import config_cache
+from utils.fsm import utc_now
+from utils.user_cache import user_cache
+
+
+# banned users live in their own collection, one document per user keyed by the
+# telegram id, filters check an in-memory copy that a change stream keeps in
+# sync, expired bans are removed by a TTL index and ignored until then
+class BanList:
+    def __init__(self):
+        self._collection: AsyncCollection | None = None
+        # user id -> expiry, None for permanent bans
+        self._bans: dict[int, datetime | None] = {}
+        self._watcher: asyncio.Task | None = None
+
+    def bind(self, collection: AsyncCollection) -> None:
+        self._collection = collection
+        self._bans = {}
+
+    async def load(self) -> None:
+        bans = await self._collection.find({}, {"expires_at": 1}).to_list()
+        self._bans = {ban["_id"]: ban.get("expires_at") for ban in bans}
+
+    def is_banned(self, user_id: int) -> bool:
+        if user_id not in self._bans:
+            return False
+        expires_at = self._bans[user_id]
+        return expires_at is None or expires_at > utc_now()
+
+    def expires_at(self, user_id: int) -> datetime | None:
+        return self._bans.get(user_id)
+
+    def ids(self) -> list[int]:
+        return [user_id for user_id in self._bans if self.is_banned(user_id)]
+
+    async def ban(
+        self,
+        user_id: int,
+        serial_number: int | None,
+        banned_by: int | None,
+        expires_at: datetime | None = None,
+        reason: str | None = None,
+    ) -> None:
+        # replaces an expired ban the TTL monitor hasn't removed yet
+        await self._collection.replace_one(
+            {"_id": user_id},
+            {
+                "serial_number": serial_number,
+                "banned_by": banned_by,
+                "banned_at": utc_now(),
+                "expires_at": expires_at,
+                "reason": reason,
+            },
+            upsert=True,
+        )
+        self._bans[user_id] = expires_at
+
+    async def unban(self, user_id: int) -> None:
+        await self._collection.delete_one({"_id": user_id})
+        self._bans.pop(user_id, None)
+
+    async def migrate(self) -> None:
+        # bans used to be an array in the config document
+        config = await config_cache.find_one({"banned_users": 1})
+        if not config or "banned_users" not in config:
+            return
+
+        for user_id in config["banned_users"]:
+            user = await user_cache.get(user_id)
+            await self._collection.update_one(
+                {"_id": user_id},
+                {
+                    "$setOnInsert": {
+                        "serial_number": user.serial_number if user else None,
+                        "banned_by": None,
+                        "banned_at": utc_now(),
+                        "expires_at": None,
+                        "reason": None,
+                    }
+                },
+                upsert=True,
+            )
+        await config_cache.update({"$unset": {"banned_users": ""}})
+        await self.load()
+
+    def watch(self, client) -> None:
+        if not self._watcher:
+            self._watcher = asyncio.create_task(
+                watch_forever(
+                    client, self._collection, "Bans", self._on_change, self.load
+                )
+            )
+
+    def _on_change(self, change: dict) -> None:
+        operation = change["operationType"]
+        if operation == "delete":
+            self._bans.pop(change["documentKey"]["_id"], None)
+        elif change.get("fullDocument"):
+            ban = change["fullDocument"]
+            self._bans[ban["_id"]] = ban.get("expires_at")
+
+
+ban_list = BanList()
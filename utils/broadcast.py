@@ -0,0 +1,243 @@
+import asyncio
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pyrogram import Client, errors, types
+
+from utils.log import log
+from utils.outbox import BULK, outbox
+from utils.rate_limit import TokenBucket
+
+# users fetched and checked against delivery records per round-trip
+PAGE_SIZE = 500
+
+# delivery records written per bulk write, users delivered after the last
+# flush may receive the message again if the bot crashes
+FLUSH_SIZE = 50
+
+# seconds between progress message edits
+PROGRESS_INTERVAL = 5
+
+# errors after which retrying a user is pointless
+PERMANENT_ERRORS = (
+    errors.UserIsBlocked,
+    errors.InputUserDeactivated,
+    errors.PeerIdInvalid,
+    errors.UserIsBot,
+)
+
+
+# broadcast jobs are persisted in Mongo with a delivery record per user, so a
+# job is resumed after a restart without messaging delivered users again
+class BroadcastEngine:
+    def __init__(self):
+        self.rate = 25
+        self.workers = 8
+        self.done_markup = None
+        self._db = None
+        self._bucket: TokenBucket | None = None
+        self._tasks: dict[ObjectId, asyncio.Task] = {}
+
+    def bind(self, db, rate: float = 25, workers: int = 8, done_markup=None) -> None:
+        self._db = db
+        self.rate = rate
+        self.workers = workers
+        self.done_markup = done_markup
+        # one bucket shared by all jobs, Telegram limits are global to the bot
+        self._bucket = TokenBucket(rate)
+
+    async def start(
+        self,
+        client: Client,
+        from_chat_id: int,
+        message_id: int,
+        progress_message: types.Message,
+    ) -> None:
+        total = await self._db.users.estimated_document_count()
+        job = {
+            "admin_id": progress_message.chat.id,
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "status": "running",
+            "total": total,
+            "sent": 0,
+            "failed": 0,
+            "progress_message_id": progress_message.id,
+            "created_at": datetime.now(timezone.utc),
+        }
+        result = await self._db.broadcasts.insert_one(job)
+        job["_id"] = result.inserted_id
+        self._spawn(client, job)
+        await self._edit_progress(client, job, {"sent": 0, "failed": 0})
+
+    async def resume(self, client: Client) -> None:
+        async for job in self._db.broadcasts.find({"status": "running"}):
+            if job["_id"] not in self._tasks:
+                await log(client, f"Resuming broadcast {job['_id']}")
+                self._spawn(client, job)
+
+    async def stop(self) -> None:
+        # stops the running jobs once their delivery records are written
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, client: Client, job: dict) -> None:
+        task = asyncio.create_task(self._run(client, job))
+        self._tasks[job["_id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["_id"], None))
+
+    async def _run(self, client: Client, job: dict) -> None:
+        queue = asyncio.Queue(maxsize=PAGE_SIZE)
+        results = []
+        counters = {"sent": job["sent"], "failed": job["failed"]}
+
+        async def flush():
+            if not results:
+                return
+            batch = results.copy()
+            results.clear()
+            try:
+                await self._db.broadcast_deliveries.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": f"{job['_id']}:{user_id}"},
+                            {
+                                "$set": {
+                                    "job_id": job["_id"],
+                                    "user_id": user_id,
+                                    "status": status,
+                                    "delivered_at": datetime.now(timezone.utc),
+                                }
+                            },
+                            upsert=True,
+                        )
+                        for user_id, status in batch
+                    ],
+                    ordered=False,
+                )
+            except asyncio.CancelledError:
+                # written by the flush of the stopped job, see stop()
+                results.extend(batch)
+                raise
+            sent = sum(1 for _, status in batch if status == "sent")
+            await self._db.broadcasts.update_one(
+                {"_id": job["_id"]},
+                {"$inc": {"sent": sent, "failed": len(batch) - sent}},
+            )
+
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    status = await self._deliver(client, job, user_id)
+                    counters[status] += 1
+                    results.append((user_id, status))
+                    if len(results) >= FLUSH_SIZE:
+                        await flush()
+                except Exception as e:
+                    print(f"Broadcast worker failed, it says: {e}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        progress = asyncio.create_task(self._report_progress(client, job, counters))
+
+        try:
+            last_user_id = None
+            while True:
+                page_filter = {"_id": {"$gt": last_user_id}} if last_user_id else {}
+                users_ids = [
+                    user["_id"]
+                    for user in await self._db.users.find(page_filter, {"_id": 1})
+                    .sort("_id", 1)
+                    .limit(PAGE_SIZE)
+                    .to_list()
+                ]
+                if not users_ids:
+                    break
+                last_user_id = users_ids[-1]
+
+                delivered = await self._db.broadcast_deliveries.find(
+                    {"_id": {"$in": [f"{job['_id']}:{i}" for i in users_ids]}},
+                    {"user_id": 1},
+                ).to_list()
+                delivered_ids = {delivery["user_id"] for delivery in delivered}
+
+                for user_id in users_ids:
+                    if user_id not in delivered_ids:
+                        await queue.put(user_id)
+
+            await queue.join()
+            await flush()
+        except asyncio.CancelledError:
+            # the bot is stopping, the job stays running and is resumed on the
+            # next start, deliveries still in flight may be sent again then
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await flush()
+            raise
+        finally:
+            for task in workers + [progress]:
+                task.cancel()
+
+        await self._db.broadcasts.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}},
+        )
+        await self._edit_progress(client, job, counters, done=True)
+        await outbox.send_message(
+            client,
+            job["admin_id"],
+            f"This message has been succefully broadcasted to {counters['sent']} of bot users  ✅",
+            reply_to_message_id=job["message_id"],
+            reply_markup=self.done_markup,
+        )
+
+    async def _deliver(self, client: Client, job: dict, user_id: int) -> str:
+        # the outbox retries on FloodWait, broadcasts yield to interactive messages
+        await self._bucket.acquire()
+        try:
+            await outbox.copy_message(
+                client, user_id, job["from_chat_id"], job["message_id"], priority=BULK
+            )
+        except PERMANENT_ERRORS:
+            return "failed"
+        except Exception as e:
+            print(f"Broadcast to {user_id} failed, it says: {e}")
+            return "failed"
+        else:
+            return "sent"
+
+    async def _report_progress(self, client: Client, job: dict, counters: dict):
+        reported = None
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            if reported != counters:
+                reported = counters.copy()
+                await self._edit_progress(client, job, counters)
+
+    async def _edit_progress(
+        self, client: Client, job: dict, counters: dict, done: bool = False
+    ) -> None:
+        reached = counters["sent"] + counters["failed"]
+        text = (
+            f"Broadcast {'finished ✅' if done else 'in progress ⏳'}\n\n"
+            f"<b>Reached</b>: {reached}/{job['total']} users.\n"
+            f"<b>Delivered</b>: {counters['sent']}.\n"
+            f"<b>Failed</b>: {counters['failed']}."
+        )
+        try:
+            await client.edit_message_text(
+                job["admin_id"], job["progress_message_id"], text
+            )
+        except errors.MessageNotModified:
+            pass
+        except Exception as e:
+            print(f"Failed to update broadcast progress, it says: {e}")
+
+
+broadcasts = BroadcastEngine()
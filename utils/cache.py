@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+
+# keeps the result of a coroutine for `ttl` seconds, callers that arrive while it
+# is being computed wait for the same computation instead of starting their own
+class CachedResult:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._future: asyncio.Future | None = None
+        self._expires_at = 0.0
+
+    async def get(self, compute):
+        if self._future is None or (
+            self._future.done() and time.monotonic() >= self._expires_at
+        ):
+            self._future = asyncio.ensure_future(compute())
+            self._future.add_done_callback(self._on_done)
+
+        # a caller giving up must not cancel the computation for the others
+        return await asyncio.shield(self._future)
+
+    def _on_done(self, future: asyncio.Future) -> None:
+        # failures are not cached
+        if future.cancelled() or future.exception():
+            self._expires_at = 0
+        else:
+            self._expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self) -> None:
+        self._expires_at = 0
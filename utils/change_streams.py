@@ -0,0 +1,37 @@
+import asyncio
+import inspect
+
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import PyMongoError
+
+from utils.log import log
+
+# error code of change streams on a standalone server
+CHANGE_STREAMS_NOT_SUPPORTED = 40573
+
+
+async def watch_forever(
+    client, collection: AsyncCollection, name: str, on_change, on_resync
+) -> None:
+    # keeps an in-memory copy of `collection` in sync across bot instances,
+    # `on_change` gets every change and `on_resync`, sync or async, is called
+    # whenever the stream opens, as changes may have been missed while it was
+    # down, reconnects with a backoff and stops where change streams aren't
+    # supported, leaving the copy to its local writes
+    retry_delay = 1
+    while True:
+        try:
+            async with await collection.watch(full_document="updateLookup") as stream:
+                resynced = on_resync()
+                if inspect.isawaitable(resynced):
+                    await resynced
+                retry_delay = 1
+                async for change in stream:
+                    on_change(change)
+        except PyMongoError as e:
+            if getattr(e, "code", None) == CHANGE_STREAMS_NOT_SUPPORTED:
+                return await log(client, f"{name} change stream is not available: {e}")
+
+            print(f"{name} change stream interrupted, it says: {e}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
@@ -0,0 +1,72 @@
+import asyncio
+
+from pymongo.asynchronous.collection import AsyncCollection
+
+from models.config import Config
+from utils.change_streams import watch_forever
+
+
+# in-process snapshot of the config document, filters and handlers read it from
+# memory, writes go through it and a change stream keeps bot instances in sync
+class ConfigCache:
+    def __init__(self):
+        self._collection: AsyncCollection | None = None
+        self._config: Config | None = None
+        self._stale = True
+        self._version = 0
+        self._watcher: asyncio.Task | None = None
+
+    def bind(self, collection: AsyncCollection) -> None:
+        self._collection = collection
+        self.invalidate()
+
+    async def get(self) -> Config | None:
+        if self._stale:
+            return await self.refresh()
+        return self._config
+
+    async def refresh(self) -> Config | None:
+        version = self._version
+        doc = await self._collection.find_one({})
+        config = Config.from_doc(doc) if doc else None
+
+        # don't overwrite a snapshot that was invalidated while reading
+        if version == self._version:
+            self._config = config
+            self._stale = False
+        return config
+
+    def invalidate(self) -> None:
+        self._version += 1
+        self._stale = True
+
+    async def insert(self, config: Config) -> None:
+        await self._collection.insert_one(config.to_doc())
+        self.invalidate()
+
+    async def find_one(self, projection: dict) -> dict | None:
+        # fields of the document that aren't part of Config, for migrations
+        return await self._collection.find_one({}, projection)
+
+    async def update(self, update: dict) -> None:
+        await self._collection.update_one({}, update)
+        self.invalidate()
+
+    def watch(self, client) -> None:
+        if not self._watcher:
+            self._watcher = asyncio.create_task(
+                watch_forever(
+                    client, self._collection, "Config", self._on_change, self.invalidate
+                )
+            )
+
+    def _on_change(self, change: dict) -> None:
+        self._version += 1
+        if change["operationType"] in ("insert", "update", "replace"):
+            self._config = Config.from_doc(change["fullDocument"])
+            self._stale = False
+        else:
+            self._stale = True
+
+
+config_cache = ConfigCache()
@@ -0,0 +1,80 @@
+from pymongo import AsyncMongoClient
+from pyrogram import Client, types
+
+from models.config import Config
+from models.user import User
+from utils.bans import ban_list
+from utils.config_cache import config_cache
+from utils.user_cache import user_cache
+
+UNSET = object()
+
+
+# per update lookups shared by the filters and the handler of the update, each
+# document is read once on first use, the context is kept on the update itself
+class UpdateContext:
+    def __init__(self, update, client: Client, db_client: AsyncMongoClient):
+        self.update = update
+        self.client = client
+        self.db_client = db_client
+        self._config = UNSET
+        self._user = UNSET
+
+    @classmethod
+    def of(cls, update, client: Client, db_client: AsyncMongoClient):
+        # pyrogram types take new attributes, like `conversation` in utils.fsm,
+        # private ones are left out when an update is printed, the context
+        # refers back to the update
+        if not hasattr(update, "_context"):
+            update._context = cls(update, client, db_client)
+        return update._context
+
+    @property
+    def chat(self) -> types.Chat | None:
+        if isinstance(self.update, types.CallbackQuery):
+            return self.update.message.chat if self.update.message else None
+        return self.update.chat
+
+    async def config(self) -> Config | None:
+        if self._config is UNSET:
+            self._config = await config_cache.get()
+        return self._config
+
+    async def user(self) -> User | None:
+        # the bot user of the sender
+        if self._user is UNSET:
+            self._user = await user_cache.get(self.update.from_user.id)
+        return self._user
+
+    async def is_admin(self) -> bool:
+        config = await self.config()
+        return bool(
+            config
+            and self.update.from_user
+            and self.update.from_user.id in config.admins_list
+        )
+
+    async def is_user(self) -> bool:
+        # anyone but admins, banned users and the bot itself
+        config = await self.config()
+        sender = self.update.from_user
+        return bool(
+            config
+            and sender
+            and not ban_list.is_banned(sender.id)
+            and sender.id != self.client.me.id
+            and not await self.is_admin()
+        )
+
+    async def in_staff_chat(self) -> bool:
+        config = await self.config()
+        return bool(config and self.chat and self.chat.id == config.staff_chat_id)
+
+    async def role(self) -> str | None:
+        if await self.in_staff_chat():
+            return "staff"
+        if await self.is_admin():
+            return "admin"
+        if await self.is_user():
+            return "user"
+        return None
@@ -0,0 +1,54 @@
+import asyncio
+
+from pymongo import ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+
+
+# hands out serial numbers from an atomic counter document, a block of serials
+# can be reserved per round-trip, unused serials of a block are skipped on restart
+class SerialAllocator:
+    def __init__(self, name: str):
+        self.name = name
+        self.block_size = 1
+        self._collection: AsyncCollection | None = None
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    def bind(self, collection: AsyncCollection, block_size: int = 1) -> None:
+        self._collection = collection
+        self.block_size = max(block_size, 1)
+
+    async def seed(self, users: AsyncCollection) -> None:
+        # one time migration from serials that were counted from the users collection
+        if await self._collection.find_one({"_id": self.name}):
+            return
+
+        last_user = await users.find_one(
+            {}, {"serial_number": 1}, sort=[("serial_number", -1)]
+        )
+        last_serial = last_user["serial_number"] if last_user else 0
+
+        # $max keeps the counter safe if another bot instance seeds it concurrently
+        await self._collection.update_one(
+            {"_id": self.name}, {"$max": {"value": last_serial}}, upsert=True
+        )
+
+    async def next(self) -> int:
+        async with self._lock:
+            if self._next >= self._end:
+                counter = await self._collection.find_one_and_update(
+                    {"_id": self.name},
+                    {"$inc": {"value": self.block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                self._end = counter["value"] + 1
+                self._next = self._end - self.block_size
+
+            serial = self._next
+            self._next += 1
+            return serial
+
+
+user_serials = SerialAllocator("user_serial")
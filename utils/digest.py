@@ -0,0 +1,120 @@
+import asyncio
+import html
+import re
+
+from pyrogram import Client, enums
+
+from utils.log import ERROR, log
+from utils.outbox import outbox
+
+# user messages longer than this are still forwarded on their own
+SHORT_TEXT_LENGTH = 300
+
+# Telegram's message length limit, with room for the header and footer
+MAX_DIGEST_LENGTH = 3800
+
+FOOTER = "You can reply to them with the reply command!"
+
+
+def plain_text(text: str) -> str:
+    # the log channel gets plain text, user text in entries is HTML escaped
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
+
+
+# coalesces staff chat notifications into one message per window, so a burst
+# of users doesn't burn the staff group's 20 messages per minute
+class StaffDigest:
+    def __init__(self):
+        # 0 disables digest mode, notifications are sent right away
+        self.window = 0
+        self.max_events = 20
+        self._pending: dict[int, list[str]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # _send_later tasks still waiting for their window
+        self._timers: set[asyncio.Task] = set()
+
+    def bind(self, window: float = 0, max_events: int = 20) -> None:
+        self.window = window
+        self.max_events = max_events
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def fits(self, text: str | None) -> bool:
+        # media and long messages keep being copied individually
+        return self.enabled and bool(text) and len(text) <= SHORT_TEXT_LENGTH
+
+    def add(self, client: Client, chat_id: int, entry: str) -> None:
+        entries = self._pending.setdefault(chat_id, [])
+        entries.append(entry)
+
+        if len(entries) >= self.max_events:
+            del self._pending[chat_id]
+            self._spawn(self._send(client, chat_id, entries))
+        elif len(entries) == 1:
+            self._timers.add(self._spawn(self._send_later(client, chat_id, entries)))
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def flush(self, client: Client) -> None:
+        # sends the batches waiting for their window right away, on shutdown,
+        # the users behind them were already told the staff got their messages
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+
+        pending, self._pending = self._pending, {}
+        for chat_id, entries in pending.items():
+            await self._send(client, chat_id, entries)
+        # and waits for the batches that were already being sent
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _send_later(self, client: Client, chat_id: int, entries: list[str]):
+        await asyncio.sleep(self.window)
+        self._timers.discard(asyncio.current_task())
+
+        # the batch was already sent when it reached max_events
+        if self._pending.get(chat_id) is entries:
+            del self._pending[chat_id]
+            await self._send(client, chat_id, entries)
+
+    async def _send(self, client: Client, chat_id: int, entries: list[str]):
+        for text in self._messages(entries):
+            try:
+                await outbox.send_message(
+                    client, chat_id, text, parse_mode=enums.ParseMode.HTML
+                )
+            except Exception as e:
+                # keep the notifications in the log channel instead of losing them
+                await log(
+                    client, f"Failed to send staff digest, it says: {e}", level=ERROR
+                )
+                await log(client, plain_text(text))
+
+    def _messages(self, entries: list[str]):
+        chunk = []
+        length = 0
+        for entry in entries:
+            if chunk and length + len(entry) > MAX_DIGEST_LENGTH:
+                yield self._format(chunk)
+                chunk, length = [], 0
+            chunk.append(entry)
+            length += len(entry) + 2
+        if chunk:
+            yield self._format(chunk)
+
+    @staticmethod
+    def _format(entries: list[str]) -> str:
+        return (
+            f"<b>Hey MASA staff!, {len(entries)} new notifications:</b>\n\n"
+            + "\n\n".join(entries)
+            + f"\n\n{FOOTER}"
+        )
+
+
+staff_digest = StaffDigest()
@@ -0,0 +1,148 @@
+import time
+from datetime import timedelta
+
+from pyrogram import Client, StopPropagation, enums, types
+
+from utils.bans import ban_list
+from utils.config_cache import config_cache
+from utils.fsm import utc_now
+from utils.log import WARNING, log
+from utils.metrics import FLOOD_DROPS
+from utils.outbox import outbox
+from utils.rate_limit import TokenBucket
+from utils.user_cache import user_cache
+
+# seconds over which dropped updates are counted towards a temporary ban
+STRIKE_WINDOW = 60
+
+# idle user buckets are dropped when there are more than this
+MAX_BUCKETS = 10_000
+
+
+# per user token bucket in front of the handlers, runs before the filters that
+# read the database, updates over the limit are dropped and users who keep
+# flooding the bot are banned for a while
+class FloodGuard:
+    def __init__(self):
+        self.rate = 1.0
+        self.burst = 10.0
+        # dropped updates within STRIKE_WINDOW before a ban, 0 disables bans
+        self.ban_threshold = 60
+        self.ban_minutes = 60
+        self._buckets: dict[int, TokenBucket] = {}
+        # user id -> (strike window start, dropped updates)
+        self._strikes: dict[int, tuple[float, int]] = {}
+
+    def bind(
+        self,
+        rate: float = 1,
+        burst: float = 10,
+        ban_threshold: int = 60,
+        ban_minutes: int = 60,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.ban_threshold = ban_threshold
+        self.ban_minutes = ban_minutes
+        self._buckets = {}
+        self._strikes = {}
+
+    async def check(self, client: Client, update) -> None:
+        # only private chats with the bot, the staff chat isn't limited
+        sender = update.from_user
+        if isinstance(update, types.CallbackQuery):
+            chat = update.message.chat if update.message else None
+        else:
+            chat = update.chat
+        if not sender or not chat or chat.type != enums.ChatType.PRIVATE:
+            return
+
+        # the config is kept in memory, see utils/config_cache.py
+        config = await config_cache.get()
+        if config and sender.id in config.admins_list:
+            return
+
+        if ban_list.is_banned(sender.id):
+            FLOOD_DROPS.inc(reason="banned")
+            raise StopPropagation
+
+        if self._bucket(sender.id).try_acquire():
+            return
+
+        FLOOD_DROPS.inc(reason="flood")
+        if self._strike(sender.id):
+            await self._ban(client, sender.id)
+        raise StopPropagation
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket:
+            return bucket
+
+        if len(self._buckets) >= MAX_BUCKETS:
+            self._buckets = {
+                user: bucket
+                for user, bucket in self._buckets.items()
+                if bucket.delay(bucket.capacity) > 0
+            }
+
+        bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _strike(self, user_id: int) -> bool:
+        # True when the user went over the ban threshold
+        if not self.ban_threshold:
+            return False
+
+        now = time.monotonic()
+        started, count = self._strikes.get(user_id, (now, 0))
+        if now - started > STRIKE_WINDOW:
+            started, count = now, 0
+        count += 1
+
+        if count >= self.ban_threshold:
+            self._strikes.pop(user_id, None)
+            return True
+
+        if len(self._strikes) >= MAX_BUCKETS:
+            self._strikes = {
+                user: strikes
+                for user, strikes in self._strikes.items()
+                if now - strikes[0] <= STRIKE_WINDOW
+            }
+        self._strikes[user_id] = (started, count)
+        return False
+
+    async def _ban(self, client: Client, user_id: int) -> None:
+        user = await user_cache.get(user_id)
+        await ban_list.ban(
+            user_id,
+            user.serial_number if user else None,
+            None,
+            utc_now() + timedelta(minutes=self.ban_minutes),
+            reason="flood",
+        )
+
+        if not user:
+            return await log(
+                client,
+                f"An unregistered user was banned for {self.ban_minutes} minutes "
+                "for flooding the bot.",
+                level=WARNING,
+            )
+
+        config = await config_cache.get()
+        for admin_id in config.admins_list if config else []:
+            try:
+                await outbox.send_message(
+                    client,
+                    admin_id,
+                    f"User {user.display_name} has been banned for "
+                    f"{self.ban_minutes} minutes for flooding the bot.\n\n"
+                    f"/unban_{user.serial_number}",
+                )
+            except Exception as e:
+                await log(client, f"Failed to message admin {admin_id}, it says: {e}")
+
+
+flood_guard = FloodGuard()
@@ -0,0 +1,160 @@
+import asyncio
+import secrets
+from datetime import datetime, timedelta, timezone
+
+from pymongo.asynchronous.collection import AsyncCollection
+from pyrogram import filters
+
+from utils.change_streams import watch_forever
+
+# conversations left idle longer than this are dropped
+STATE_TTL = 60 * 60
+
+# expired states are dropped from memory when there are more than this
+MAX_STATES = 10_000
+
+
+def utc_now() -> datetime:
+    # pymongo returns naive UTC datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# per chat member conversation state persisted in Mongo, handlers are stateless
+# transitions between states and pending conversations survive restarts, the
+# states are also kept in memory so state filters and clears of chats without a
+# conversation don't read the database, a change stream keeps them in sync
+class StateStore:
+    def __init__(self):
+        self.ttl = STATE_TTL
+        self._collection: AsyncCollection | None = None
+        # chat:user key -> state document
+        self._states: dict[str, dict] = {}
+        self._watcher: asyncio.Task | None = None
+
+    def bind(self, collection: AsyncCollection, ttl: int = STATE_TTL) -> None:
+        self._collection = collection
+        self.ttl = ttl
+        self._states = {}
+
+    async def load(self) -> None:
+        states = await self._collection.find(
+            {"expires_at": {"$gt": utc_now()}}
+        ).to_list()
+        self._states = {state["_id"]: state for state in states}
+
+    @staticmethod
+    def _key(chat_id: int, user_id: int) -> str:
+        return f"{chat_id}:{user_id}"
+
+    def get(self, chat_id: int, user_id: int) -> dict | None:
+        key = self._key(chat_id, user_id)
+        state = self._states.get(key)
+
+        # the TTL monitor removes expired states only once a minute
+        if state and state["expires_at"] <= utc_now():
+            del self._states[key]
+            return None
+        return state
+
+    async def set(self, chat_id: int, user_id: int, name: str, /, **data) -> str:
+        # the arguments are positional only, staff conversations store the
+        # user they are about in their data as `user_id`
+
+        # the nonce is put in the callback data of the state's buttons, so
+        # buttons of older conversations can't trigger this one
+        nonce = secrets.token_hex(4)
+        key = self._key(chat_id, user_id)
+        state = {
+            "state": name,
+            "data": data,
+            "nonce": nonce,
+            "expires_at": utc_now() + timedelta(seconds=self.ttl),
+        }
+        await self._collection.replace_one({"_id": key}, state, upsert=True)
+
+        if len(self._states) >= MAX_STATES:
+            now = utc_now()
+            self._states = {
+                key: state
+                for key, state in self._states.items()
+                if state["expires_at"] > now
+            }
+        self._states[key] = {"_id": key, **state}
+        return nonce
+
+    async def pop(
+        self, chat_id: int, user_id: int, nonce: str, name: str | None = None
+    ) -> dict | None:
+        state = self.get(chat_id, user_id)
+        # buttons of conversations that are over don't reach the database
+        if not state or state["nonce"] != nonce or (name and state["state"] != name):
+            return None
+
+        # consumed atomically, pressing the same button twice finds nothing
+        query = {
+            "_id": self._key(chat_id, user_id),
+            "nonce": nonce,
+            "expires_at": {"$gt": utc_now()},
+        }
+        if name:
+            query["state"] = name
+        state = await self._collection.find_one_and_delete(query)
+        self._drop(query["_id"], nonce)
+        return state
+
+    async def clear(self, chat_id: int, user_id: int) -> None:
+        # most /start commands and back buttons come without a conversation
+        key = self._key(chat_id, user_id)
+        if key not in self._states:
+            return
+
+        nonce = self._states[key]["nonce"]
+        await self._collection.delete_one({"_id": key})
+        self._drop(key, nonce)
+
+    def _drop(self, key: str, nonce: str) -> None:
+        # unless a new conversation was set meanwhile
+        state = self._states.get(key)
+        if state and state["nonce"] == nonce:
+            del self._states[key]
+
+    def watch(self, client) -> None:
+        if not self._watcher:
+            self._watcher = asyncio.create_task(
+                watch_forever(
+                    client,
+                    self._collection,
+                    "Conversations",
+                    self._on_change,
+                    self.load,
+                )
+            )
+
+    def _on_change(self, change: dict) -> None:
+        operation = change["operationType"]
+        if operation == "delete":
+            self._states.pop(change["documentKey"]["_id"], None)
+        elif change.get("fullDocument"):
+            state = change["fullDocument"]
+            self._states[state["_id"]] = state
+
+
+conversations = StateStore()
+
+
+def in_state(*names: str) -> filters.Filter:
+    async def func(_, __, update):
+        if not update.from_user:
+            return False
+
+        # several state filters may check the same update, look it up once
+        if not hasattr(update, "conversation"):
+            update.conversation = conversations.get(update.chat.id, update.from_user.id)
+        return bool(update.conversation and update.conversation["state"] in names)
+
+    return filters.create(func, "InStateFilter")
+
+
+def callback_nonce(callback_data: str) -> str:
+    # callback data of state buttons looks like `action:nonce`
+    return callback_data.split(":", 1)[-1]
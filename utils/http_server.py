@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from aiohttp import web
+from pyrogram import Client
+
+from utils.watchdog import loop_watchdog
+
+# seconds to wait for Mongo to answer a readiness ping
+MONGO_PING_TIMEOUT = 2
+
+
+# health and metrics endpoints served from the bot's own event loop, a
+# blocked loop shows up as lag instead of being hidden by a server thread, the
+# lag is measured by the watchdog's heartbeat, see utils/watchdog.py
+class HealthServer:
+    def __init__(self):
+        self.max_loop_lag = 1.0
+        self._client: Client | None = None
+        self._mongo_client = None
+        self._collectors = []
+        self._started_at = time.monotonic()
+        self._runner: web.AppRunner | None = None
+
+    def bind(self, client: Client, mongo_client, max_loop_lag: float = 1.0) -> None:
+        self._client = client
+        self._mongo_client = mongo_client
+        self.max_loop_lag = max_loop_lag
+
+    def add_collector(self, collect) -> None:
+        # `collect` returns lines in the Prometheus text format
+        self._collectors.append(collect)
+
+    async def start(self, port: int) -> None:
+        # main() is called again after a crash, the server keeps running
+        if self._runner:
+            return
+
+        app = web.Application()
+        app.router.add_get("/", self._greet)
+        app.router.add_get("/healthz", self._healthz)
+        app.router.add_get("/readyz", self._readyz)
+        app.router.add_get("/metrics", self._metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "0.0.0.0", port).start()
+
+    async def _mongo_reachable(self) -> bool:
+        try:
+            await asyncio.wait_for(
+                self._mongo_client.admin.command("ping"), MONGO_PING_TIMEOUT
+            )
+        except Exception:
+            return False
+        return True
+
+    async def _greet(self, request: web.Request) -> web.Response:
+        return web.Response(text="MASA Hotline Bot is UP!")
+
+    async def _healthz(self, request: web.Request) -> web.Response:
+        # the process is alive and the event loop answers
+        return web.json_response({"status": "ok"})
+
+    async def _readyz(self, request: web.Request) -> web.Response:
+        checks = {
+            "telegram": bool(self._client and self._client.is_connected),
+            "mongo": await self._mongo_reachable(),
+            "event_loop": loop_watchdog.loop_lag < self.max_loop_lag,
+        }
+        ready = all(checks.values())
+        return web.json_response(
+            {"status": "ready" if ready else "not ready", "checks": checks},
+            status=200 if ready else 503,
+        )
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        lines = [
+            "# TYPE masa_bot_uptime_seconds gauge",
+            f"masa_bot_uptime_seconds {time.monotonic() - self._started_at:.3f}",
+            "# TYPE masa_bot_event_loop_lag_seconds gauge",
+            f"masa_bot_event_loop_lag_seconds {loop_watchdog.loop_lag:.6f}",
+            "# TYPE masa_bot_telegram_connected gauge",
+            f"masa_bot_telegram_connected {int(bool(self._client and self._client.is_connected))}",
+        ]
+        for collect in self._collectors:
+            lines.extend(collect())
+        return web.Response(text="\n".join(lines) + "\n")
+
+
+health_server = HealthServer()
@@ -0,0 +1,77 @@
+from pymongo import ASCENDING, IndexModel
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import OperationFailure
+
+from utils.log import log
+
+# custom names are unique regardless of letter case
+CASE_INSENSITIVE = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+# indexes the bot relies on, keyed by collection name
+MANAGED_INDEXES = {
+    "users": [
+        IndexModel("serial_number", name="serial_number_unique", unique=True),
+        # users are stored with custom_name: null, a sparse index would still
+        # index these, so only documents with an actual name are indexed
+        IndexModel(
+            "custom_name",
+            name="custom_name_unique",
+            unique=True,
+            collation=CASE_INSENSITIVE,
+            partialFilterExpression={"custom_name": {"$type": "string"}},
+        ),
+        # serves the statistics counts and the paginated user lists
+        IndexModel(
+            [("filled_form", ASCENDING), ("serial_number", ASCENDING)],
+            name="filled_form_serial_number",
+        ),
+    ],
+    "broadcast_deliveries": [
+        # delivery records are only needed while their broadcast can be resumed
+        IndexModel(
+            "delivered_at",
+            name="delivered_at_ttl",
+            expireAfterSeconds=30 * 24 * 60 * 60,
+        ),
+    ],
+    "bans": [
+        # temporary bans are removed once they expire, permanent ones have no
+        # expiry and are kept
+        IndexModel("expires_at", name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "conversations": [
+        # each conversation document carries its own expiry time
+        IndexModel("expires_at", name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+
+async def ensure_indexes(client, db) -> None:
+    built = []
+    missing = []
+    for collection_name, indexes in MANAGED_INDEXES.items():
+        collection = db[collection_name]
+        existing_indexes = await (await collection.list_indexes()).to_list()
+        existing_names = {index["name"] for index in existing_indexes}
+
+        for index in indexes:
+            index_name = f"{collection_name}.{index.document['name']}"
+            if index.document["name"] in existing_names:
+                continue
+
+            try:
+                await collection.create_indexes([index])
+            except OperationFailure as e:
+                missing.append(f"❌ {index_name}: {e}")
+            else:
+                built.append(f"✅ {index_name}")
+
+    if not built and not missing:
+        return
+
+    await log(
+        client,
+        "Database Indexes:\n\n"
+        + ("Built:\n" + "\n".join(built) + "\n\n" if built else "")
+        + ("Missing:\n" + "\n".join(missing) if missing else ""),
+    )
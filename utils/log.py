@@ -1,4 +1,14 @@
+import asyncio
+import json
+import logging
 import os
+from collections import deque
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from pyrogram import enums
+
+from utils.outbox import outbox
 
 is_production = os.getenv("PRODUCTION", None)
 if not is_production or is_production == "0":
@@ -8,8 +18,123 @@ if not is_production or is_production == "0":
 
 LOG_CHANNEL_ID = int(os.getenv("LOG_CHANNEL_ID"))
 
+# lines below this level are only written to the log file
+LOG_LEVEL = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+
+# lines that couldn't be sent to the log channel end up here
+LOG_FILE = os.getenv("LOG_FILE", "bot_log.jsonl")
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+# seconds between log channel messages, lines logged meanwhile are batched
+SHIP_INTERVAL = 5
+
+# lines waiting to be shipped, the oldest are moved to the file when it's full
+MAX_QUEUED = 1000
+
+MAX_MESSAGE_LENGTH = 4096
+
+file_sink = logging.getLogger("masa_bot.log_file")
+file_sink.propagate = False
+file_sink.setLevel(logging.DEBUG)
+
+
+def write_to_file(records: list[dict]) -> None:
+    if not file_sink.handlers:
+        file_sink.addHandler(
+            RotatingFileHandler(
+                LOG_FILE,
+                maxBytes=5 * 1024 * 1024,
+                backupCount=3,
+                encoding="utf-8",
+                delay=True,
+            )
+        )
+    for record in records:
+        line = {**record, "level": logging.getLevelName(record["level"])}
+        file_sink.log(record["level"], json.dumps(line, ensure_ascii=False))
+
+
+# ships log lines to the log channel from a background task, a logging storm
+# becomes a few messages with repeated lines counted instead of one per line,
+# lines are plain text, markup in them is shown as is
+class LogShipper:
+    def __init__(self):
+        self._queue: deque[dict] = deque()
+        self._task: asyncio.Task | None = None
+
+    def put(self, client, message: str, level: int) -> None:
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "level": level,
+            "message": message[:4000],
+            "count": 1,
+        }
+        if level < LOG_LEVEL:
+            return write_to_file([record])
+
+        if len(self._queue) >= MAX_QUEUED:
+            write_to_file([self._queue.popleft()])
+        self._queue.append(record)
+
+        if not self._task:
+            self._task = asyncio.create_task(self._ship_forever(client))
+
+    async def _ship_forever(self, client) -> None:
+        while True:
+            await asyncio.sleep(SHIP_INTERVAL)
+            await self.flush(client)
+
+    async def flush(self, client) -> None:
+        records = self._deduplicate()
+        for text, batch in self._messages(records):
+            try:
+                await outbox.send_message(
+                    client, LOG_CHANNEL_ID, text, parse_mode=enums.ParseMode.DISABLED
+                )
+            except Exception as e:
+                print(f"Failed to ship logs, it says: {e}")
+                write_to_file(batch)
+
+    def _deduplicate(self) -> list[dict]:
+        records: dict[tuple[int, str], dict] = {}
+        while self._queue:
+            record = self._queue.popleft()
+            key = (record["level"], record["message"])
+            if key in records:
+                records[key]["count"] += 1
+            else:
+                records[key] = record
+        return list(records.values())
+
+    @staticmethod
+    def _line(record: dict) -> str:
+        line = record["message"]
+        if record["level"] != INFO:
+            line = f"{logging.getLevelName(record['level'])}: {line}"
+        if record["count"] > 1:
+            line = f"{line} (x{record['count']})"
+        return line
+
+    def _messages(self, records: list[dict]):
+        lines, batch, length = [], [], 0
+        for record in records:
+            line = self._line(record)
+            if lines and length + len(line) > MAX_MESSAGE_LENGTH:
+                yield "\n\n".join(lines), batch
+                lines, batch, length = [], [], 0
+            lines.append(line)
+            batch.append(record)
+            length += len(line) + 2
+        if lines:
+            yield "\n\n".join(lines), batch
+
+
+log_shipper = LogShipper()
+
 
-async def log(client, message):
-    if len(message) >= 4096:
-        message = message[:4000]
-    return await client.send_message(LOG_CHANNEL_ID, message)
+async def log(client, message, level: int = INFO):
+    log_shipper.put(client, message, level)
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from pyrogram import Client, enums, errors, types
+
+from utils.log import WARNING, log
+
+# members rarely leave, and leaving is caught by chat member updates anyway
+MEMBER_TTL = 6 * 60 * 60
+
+# short, so users who just joined the chat are let in soon
+NON_MEMBER_TTL = 5 * 60
+
+# expired entries are dropped when the cache grows past this size
+MAX_ENTRIES = 50_000
+
+NOT_MEMBER_STATUSES = (enums.ChatMemberStatus.LEFT, enums.ChatMemberStatus.BANNED)
+
+
+# remembers who is in the general assembly chat so the gate doesn't call
+# get_chat_member on every /start and every back press
+class MembershipCache:
+    def __init__(self):
+        self._chat_id: int | None = None
+        self._entries: dict[int, tuple[bool, float]] = {}
+        self._syncer: asyncio.Task | None = None
+
+    def _use_chat(self, chat_id: int) -> None:
+        # the general assembly chat was changed by an admin
+        if chat_id != self._chat_id:
+            self._chat_id = chat_id
+            self._entries.clear()
+
+    def _set(self, user_id: int, is_member: bool) -> None:
+        if len(self._entries) >= MAX_ENTRIES:
+            now = time.monotonic()
+            self._entries = {
+                user: entry for user, entry in self._entries.items() if entry[1] > now
+            }
+
+        ttl = MEMBER_TTL if is_member else NON_MEMBER_TTL
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+
+    async def is_member(self, client: Client, chat_id: int, user_id: int) -> bool:
+        self._use_chat(chat_id)
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        # errors other than not being a member are raised and not cached
+        try:
+            await client.get_chat_member(chat_id, user_id)
+        except errors.UserNotParticipant:
+            is_member = False
+        else:
+            is_member = True
+
+        self._set(user_id, is_member)
+        return is_member
+
+    def on_member_updated(self, update: types.ChatMemberUpdated) -> None:
+        if update.chat.id != self._chat_id:
+            return
+
+        member = update.new_chat_member or update.old_chat_member
+        is_member = bool(
+            update.new_chat_member
+            and update.new_chat_member.status not in NOT_MEMBER_STATUSES
+        )
+        self._set(member.user.id, is_member)
+
+    def sync_periodically(self, client: Client, get_chat_id, interval: float) -> None:
+        if interval and not self._syncer:
+            self._syncer = asyncio.create_task(
+                self._sync_forever(client, get_chat_id, interval)
+            )
+
+    async def _sync_forever(self, client: Client, get_chat_id, interval: float):
+        while True:
+            chat_id = await get_chat_id()
+            if chat_id:
+                try:
+                    self._use_chat(chat_id)
+                    async for member in client.get_chat_members(chat_id):
+                        if member.status not in NOT_MEMBER_STATUSES:
+                            self._set(member.user.id, True)
+                except Exception as e:
+                    await log(
+                        client,
+                        f"Failed to sync GA chat members, it says: {e}",
+                        level=WARNING,
+                    )
+
+            await asyncio.sleep(interval)
+
+
+ga_members = MembershipCache()
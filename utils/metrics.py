@@ -0,0 +1,241 @@
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+from pyrogram import Client, errors
+
+# seconds, from a cached lookup to a slow Telegram upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels)
+    return f"{{{pairs}}}"
+
+
+# metrics are updated from Mongo driver threads too, hence the locks
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, value: float = 1, **labels) -> None:
+        self.inc(-value, **labels)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # per label set: bucket counts, then the sum and the count
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0, 0])
+            bucket = bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                counts[bucket] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, counts.copy()) for key, counts in self._values.items()]
+
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(key + (("le", bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(key + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {counts[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self) -> list[str]:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return lines
+
+
+metrics = Registry()
+
+HANDLER_SECONDS = metrics.register(
+    Histogram("masa_bot_handler_seconds", "Time spent running update handlers.")
+)
+HANDLERS_IN_PROGRESS = metrics.register(
+    Gauge("masa_bot_handlers_in_progress", "Update handlers currently running.")
+)
+FILTER_SECONDS = metrics.register(
+    Histogram("masa_bot_filter_seconds", "Time spent checking handler filters.")
+)
+MONGO_SECONDS = metrics.register(
+    Histogram("masa_bot_mongo_seconds", "Mongo command latency.")
+)
+TELEGRAM_SECONDS = metrics.register(
+    Histogram("masa_bot_telegram_seconds", "Telegram API call latency.")
+)
+TELEGRAM_FLOOD_WAITS = metrics.register(
+    Counter(
+        "masa_bot_telegram_flood_waits_total",
+        "FloodWait errors returned to the bot by Telegram.",
+    )
+)
+
+USER_CACHE_LOOKUPS = metrics.register(
+    Counter(
+        "masa_bot_user_cache_lookups_total",
+        "User lookups by key and result, hit or miss.",
+    )
+)
+
+FLOOD_DROPS = metrics.register(
+    Counter(
+        "masa_bot_flood_drops_total",
+        "Updates dropped by the flood limiter, by reason.",
+    )
+)
+
+
+def labelled(name: str | None):
+    # names an update handler in the metrics, the registered callbacks are
+    # one-line wrappers named `_` around a module function, None leaves out
+    # handlers that time the handlers they dispatch to, see utils/router.py
+    def decorate(callback):
+        callback.metrics_label = name
+        return callback
+
+    return decorate
+
+
+def handler_label(handler) -> str | None:
+    # pyrofork registers a bound method that resolves listeners before calling
+    # the decorated function, which it keeps as `original_callback`
+    callback = getattr(handler, "original_callback", handler.callback)
+    return getattr(callback, "metrics_label", callback.__qualname__)
+
+
+def instrument_handler(handler):
+    label = handler_label(handler)
+    if label is None:
+        return handler
+    callback, check = handler.callback, handler.check
+
+    async def timed_callback(client: Client, *args):
+        HANDLERS_IN_PROGRESS.inc(handler=label)
+        started = time.perf_counter()
+        try:
+            await callback(client, *args)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=label)
+            HANDLERS_IN_PROGRESS.dec(handler=label)
+
+    async def timed_check(client: Client, update) -> bool:
+        started = time.perf_counter()
+        try:
+            return await check(client, update)
+        finally:
+            FILTER_SECONDS.observe(time.perf_counter() - started, handler=label)
+
+    handler.callback = timed_callback
+    handler.check = timed_check
+    return handler
+
+
+def instrument_client(client: Client) -> None:
+    # every handler added from now on is timed, and every API call too
+    if getattr(client, "instrumented", False):
+        return
+    client.instrumented = True
+
+    add_handler, invoke = client.add_handler, client.invoke
+
+    def timed_add_handler(handler, group: int = 0):
+        return add_handler(instrument_handler(handler), group)
+
+    async def timed_invoke(query, *args, **kwargs):
+        method = type(query).__name__
+        started = time.perf_counter()
+        try:
+            return await invoke(query, *args, **kwargs)
+        except errors.FloodWait:
+            # shorter waits are slept through by pyrogram and never get here
+            TELEGRAM_FLOOD_WAITS.inc(method=method)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=method)
+
+    client.add_handler = timed_add_handler
+    client.invoke = timed_invoke
+
+
+# passed to the Mongo client, times every command by collection and operation
+class MongoCommandTimer(monitoring.CommandListener):
+    def __init__(self):
+        self._collections: dict[tuple, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names the collection separately
+            collection = event.command.get("collection", "")
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._observe(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._observe(event)
+
+    def _observe(self, event) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_SECONDS.observe(
+            event.duration_micros / 1_000_000,
+            collection=collection,
+            operation=event.command_name,
+        )
+
+
+mongo_command_timer = MongoCommandTimer()
@@ -1,11 +1,114 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import dns.resolver
+from pymongo import AsyncMongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
+# methods that don't do any I/O and return a new client object
+SYNC_METHODS = {"with_options", "get_collection", "get_database"}
+
+# methods that are awaited and return a cursor in the async driver
+CURSOR_METHODS = {"aggregate", "list_indexes", "watch"}
+
+
+class ThreadedCursor:
+    def __init__(self, cursor, executor: ThreadPoolExecutor | None = None):
+        self._cursor = cursor
+        # fetches run on the default executor unless the cursor has its own
+        self._executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        # chaining methods like sort and limit don't do any I/O
+        def chain(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return chain
+
+    def __aiter__(self):
+        return self
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def __anext__(self):
+        document = await self._run(next, self._cursor, None)
+        if document is None:
+            raise StopAsyncIteration
+        return document
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def to_list(self, length: int | None = None) -> list:
+        if length is None:
+            return await self._run(list, self._cursor)
+        return await self._run(
+            lambda: [document for _, document in zip(range(length), self._cursor)]
+        )
 
-def connect_to_db(db_uri: str) -> MongoClient:
+    async def close(self) -> None:
+        # not on the cursor's own executor, which may be waiting in next()
+        await asyncio.to_thread(self._cursor.close)
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+
+# wraps a sync client, database or collection so it is awaited like the async
+# driver, every call runs in a worker thread instead of blocking the event loop
+class ThreadedMongo:
+    def __init__(self, target: MongoClient | Database | Collection):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, (MongoClient, Database, Collection)):
+            return ThreadedMongo(attr)
+
+        if not callable(attr):
+            return attr
+
+        if name in SYNC_METHODS:
+            return lambda *args, **kwargs: ThreadedMongo(attr(*args, **kwargs))
+
+        if name == "find":
+            return lambda *args, **kwargs: ThreadedCursor(attr(*args, **kwargs))
+
+        async def call(*args, **kwargs):
+            result = await asyncio.to_thread(attr, *args, **kwargs)
+            if name == "watch":
+                # a change stream holds its thread while waiting for changes,
+                # it gets its own instead of one of the default executor's
+                executor = ThreadPoolExecutor(1, thread_name_prefix="change-stream")
+                return ThreadedCursor(result, executor)
+            return ThreadedCursor(result) if name in CURSOR_METHODS else result
+
+        return call
+
+    def __getitem__(self, name: str):
+        return ThreadedMongo(self._target[name])
+
+
+def connect_to_db(
+    db_uri: str, use_async: bool = True, **kwargs
+) -> AsyncMongoClient | ThreadedMongo:
     dns.resolver.default_resolver = dns.resolver.Resolver(configure=False)
     dns.resolver.default_resolver.nameservers = ["8.8.8.8"]
 
-    client = MongoClient(db_uri, server_api=ServerApi("1"))
-    return client
+    if use_async:
+        return AsyncMongoClient(db_uri, server_api=ServerApi("1"), **kwargs)
+
+    # fallback to the sync driver
+    client = MongoClient(db_uri, server_api=ServerApi("1"), **kwargs)
+    return ThreadedMongo(client)
@@ -0,0 +1,184 @@
+import asyncio
+import itertools
+from functools import partial
+
+from pyrogram import Client, errors, types
+
+from utils.rate_limit import TokenBucket
+
+# priority classes, lower values are sent first
+URGENT = 0  # answers to someone who is waiting on the bot
+NORMAL = 1
+BULK = 2  # broadcasts
+
+# Telegram allows 20 messages per minute in a group, a burst of 5 followed by
+# 15 per minute never goes over it
+GROUP_RATE = 15 / 60
+GROUP_BURST = 5
+
+# about one message per second in a private chat, short bursts are tolerated
+PRIVATE_RATE = 1
+PRIVATE_BURST = 3
+
+MAX_ATTEMPTS = 3
+
+# idle chat buckets are dropped when there are more than this
+MAX_BUCKETS = 10_000
+
+# seconds to wait for the queued messages on shutdown
+DRAIN_TIMEOUT = 10
+
+
+# every message the bot sends goes through here, so bursts into one chat are
+# spread out instead of failing with FloodWait
+class Outbox:
+    def __init__(self):
+        self.workers = 4
+        self._bucket: TokenBucket | None = None
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue | None = None
+        self._order = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+        # futures of the messages not sent yet
+        self._pending: set[asyncio.Future] = set()
+
+    def bind(self, rate: float = 25, workers: int = 4) -> None:
+        self.workers = workers
+        # the global limit of the bot, shared by every chat
+        self._bucket = TokenBucket(rate)
+
+    async def send_message(
+        self,
+        client: Client,
+        chat_id: int,
+        text: str,
+        priority: int = NORMAL,
+        **kwargs,
+    ) -> types.Message:
+        send = partial(client.send_message, chat_id, text, **kwargs)
+        return await self.submit(chat_id, send, priority)
+
+    async def copy_message(
+        self,
+        client: Client,
+        chat_id: int,
+        from_chat_id: int,
+        message_id: int,
+        priority: int = NORMAL,
+        **kwargs,
+    ) -> types.Message:
+        send = partial(client.copy_message, chat_id, from_chat_id, message_id, **kwargs)
+        return await self.submit(chat_id, send, priority)
+
+    async def reply(
+        self, message: types.Message, text: str, priority: int = URGENT, **kwargs
+    ) -> types.Message:
+        send = partial(message.reply, text, **kwargs)
+        return await self.submit(message.chat.id, send, priority)
+
+    async def copy(
+        self, message: types.Message, chat_id: int, priority: int = NORMAL, **kwargs
+    ) -> types.Message:
+        send = partial(message.copy, chat_id, **kwargs)
+        return await self.submit(chat_id, send, priority)
+
+    async def submit(self, chat_id: int, send, priority: int = NORMAL):
+        # resolves to the sent message, or raises the error Telegram returned
+        if not self._tasks:
+            self._start()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        self._queue.put_nowait((priority, next(self._order), 1, chat_id, send, future))
+        return await future
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        # on shutdown, sends what is queued or waiting on a chat's limit for up
+        # to `timeout` seconds, then stops the workers, messages still unsent
+        # fail instead of leaving their senders waiting
+        if self._pending:
+            await asyncio.wait(set(self._pending), timeout=timeout)
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for future in list(self._pending):
+            if not future.done():
+                future.set_exception(ConnectionError("The bot is stopping"))
+
+    def metrics(self) -> list[str]:
+        queued = self._queue.qsize() if self._queue else 0
+        return [
+            "# TYPE masa_bot_outbox_queued gauge",
+            f"masa_bot_outbox_queued {queued}",
+        ]
+
+    def _start(self) -> None:
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket:
+            return bucket
+
+        if len(self._chat_buckets) >= MAX_BUCKETS:
+            self._chat_buckets = {
+                chat: bucket
+                for chat, bucket in self._chat_buckets.items()
+                if bucket.delay(bucket.capacity) > 0
+            }
+
+        if chat_id < 0:
+            bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+        else:
+            bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+        self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _requeue(self, job: tuple, delay: float) -> None:
+        # the job keeps its place among messages of the same priority
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            priority, order, attempt, chat_id, send, future = job
+
+            # the caller gave up waiting
+            if future.done():
+                continue
+
+            # a busy chat must not hold a worker, other chats are served meanwhile
+            chat_bucket = self._chat_bucket(chat_id)
+            if not chat_bucket.try_acquire():
+                self._requeue(job, chat_bucket.delay())
+                continue
+
+            await self._bucket.acquire()
+            try:
+                message = await send()
+            except errors.FloodWait as e:
+                # group limits are per chat, in private chats it's the bot's limit
+                if chat_id < 0:
+                    chat_bucket.pause(e.value)
+                else:
+                    self._bucket.pause(e.value)
+
+                if attempt < MAX_ATTEMPTS:
+                    job = (priority, order, attempt + 1, chat_id, send, future)
+                    self._requeue(job, e.value)
+                elif not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(message)
+
+
+outbox = Outbox()
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+
+# classic token bucket, `rate` tokens are added per second up to `capacity`
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        # seconds until `tokens` can be taken from the bucket
+        self._refill()
+        paused = max(self._paused_until - time.monotonic(), 0)
+        return max(paused, (tokens - self._tokens) / self.rate, 0)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        if self.delay(tokens) > 0:
+            return False
+        self._tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1) -> None:
+        # the lock hands tokens out in arrival order
+        async with self._lock:
+            while (delay := self.delay(tokens)) > 0:
+                await asyncio.sleep(delay)
+            self._tokens -= tokens
+
+    def pause(self, seconds: float) -> None:
+        # used when Telegram asks to wait, e.g. on FloodWait
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
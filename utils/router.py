@@ -0,0 +1,58 @@
+import inspect
+import time
+
+from pyrogram import Client, errors, types
+
+from utils.metrics import HANDLER_SECONDS, HANDLERS_IN_PROGRESS
+
+
+# routes callback queries by the action in their data (`action` or
+# `action:args`) with a dict lookup, instead of trying a regex filter per button
+class CallbackRouter:
+    def __init__(self):
+        self._routes: dict[tuple[str, str], tuple] = {}
+
+    def add(self, role: str, action: str, handler, answers: bool = False) -> None:
+        # handlers take any of `client`, `callback_query` and the dependencies
+        # passed to dispatch, by name, `answers` handlers answer the query
+        # themselves, e.g. with a notice that a confirmation has expired
+        parameters = tuple(inspect.signature(handler).parameters)
+        label = f"{handler.__module__.rsplit('.', 1)[-1]}.{handler.__name__}"
+        self._routes[(role, action)] = (handler, parameters, answers, label)
+
+    async def dispatch(
+        self,
+        role: str | None,
+        client: Client,
+        callback_query: types.CallbackQuery,
+        **dependencies,
+    ) -> None:
+        action = str(callback_query.data).split(":", 1)[0]
+        route = self._routes.get((role, action))
+
+        # stop the loading spinner on the user's button right away
+        if not route or not route[2]:
+            try:
+                await callback_query.answer()
+            except errors.BadRequest:
+                # the query is too old to be answered, still handle it
+                pass
+        if not route:
+            return
+
+        handler, parameters, _, label = route
+        arguments = {
+            "client": client,
+            "callback_query": callback_query,
+            **dependencies,
+        }
+        HANDLERS_IN_PROGRESS.inc(handler=label)
+        started = time.perf_counter()
+        try:
+            await handler(*(arguments[name] for name in parameters))
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=label)
+            HANDLERS_IN_PROGRESS.dec(handler=label)
+
+
+callback_router = CallbackRouter()
@@ -0,0 +1,120 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+from pymongo.errors import PyMongoError
+
+from utils.fsm import utc_now
+
+# seconds between writes of the counted statistics
+FLUSH_INTERVAL = 5
+
+# upper bounds in seconds of the staff first response time buckets, from a
+# minute to three days, anything slower falls in the "inf" bucket
+RESPONSE_BUCKETS = (60, 300, 900, 3600, 4 * 3600, 12 * 3600, 86400, 3 * 86400)
+
+
+def hour_of(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def day_of(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def response_bucket(seconds: float) -> str:
+    for bound in RESPONSE_BUCKETS:
+        if seconds <= bound:
+            return str(bound)
+    return "inf"
+
+
+def response_percentile(counters: dict, q: float) -> str | None:
+    # the bucket bound under which a `q` share of the first responses fall
+    buckets = counters.get("first_response_buckets", {})
+    total = sum(buckets.values())
+    if not total:
+        return None
+
+    cumulative = 0
+    for bound in (*map(str, RESPONSE_BUCKETS), "inf"):
+        cumulative += buckets.get(bound, 0)
+        if cumulative >= q * total:
+            return bound
+    return "inf"
+
+
+# counts statistics in memory and writes the deltas from a background task, per
+# flush one $inc of the lifetime totals and one of the current hour's and day's
+# buckets, instead of an update of the single statistics document per message
+class StatisticsCounters:
+    def __init__(self):
+        self._db = None
+        self.interval = FLUSH_INTERVAL
+        self._totals: Counter[str] = Counter()
+        # (collection name, bucket start) -> counts
+        self._buckets: dict[tuple[str, datetime], Counter[str]] = {}
+        self._task: asyncio.Task | None = None
+
+    def bind(self, db, interval: float = FLUSH_INTERVAL) -> None:
+        self._db = db
+        self.interval = interval
+
+    def inc(self, name: str, value: int = 1) -> None:
+        now = utc_now()
+        self._totals[name] += value
+        for bucket in (
+            ("statistics_hourly", hour_of(now)),
+            ("statistics_daily", day_of(now)),
+        ):
+            self._buckets.setdefault(bucket, Counter())[name] += value
+
+        if not self._task:
+            self._task = asyncio.create_task(self._flush_forever())
+
+    def first_response(self, seconds: float) -> None:
+        # time from a user's message to the staff's reply to it
+        self.inc("first_responses")
+        self.inc("first_response_seconds", round(seconds))
+        self.inc(f"first_response_buckets.{response_bucket(seconds)}")
+
+    async def _flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        # counts added while writing wait for the next flush
+        totals, buckets = self._totals, self._buckets
+        self._totals, self._buckets = Counter(), {}
+
+        if totals and not await self._write(self._db.statistics, {}, totals):
+            self._totals.update(totals)
+        for (collection_name, start), counters in buckets.items():
+            if not await self._write(
+                self._db[collection_name], {"_id": start}, counters, upsert=True
+            ):
+                self._buckets.setdefault((collection_name, start), Counter()).update(
+                    counters
+                )
+
+    @staticmethod
+    async def _write(collection, query: dict, counters: Counter, **kwargs) -> bool:
+        try:
+            await collection.update_one(query, {"$inc": dict(counters)}, **kwargs)
+        except PyMongoError as e:
+            print(f"Failed to write statistics, it says: {e}")
+            return False
+        return True
+
+    async def history(self, collection_name: str, since: datetime) -> list[dict]:
+        # buckets from `since` on, oldest first
+        return (
+            await self._db[collection_name]
+            .find({"_id": {"$gte": since}})
+            .sort("_id", 1)
+            .to_list()
+        )
+
+
+statistics_counters = StatisticsCounters()
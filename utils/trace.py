@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import json
+import re
+import secrets
+import time
+
+from pyrogram import enums, types
+
+from utils.config_cache import config_cache
+
+# seconds between writes of the recorded lines to the trace file
+FLUSH_INTERVAL = 5
+
+# callback data of state buttons ends with a random nonce, see utils.fsm
+NONCE = re.compile(r":[0-9a-f]{8}$")
+
+DIGITS = re.compile(r"\d+")
+
+
+# records the shape of the traffic to a JSON-lines file for bench/replay.py,
+# users are pseudonymous and no message content is kept
+class TraceRecorder:
+    def __init__(self):
+        self.path = ""
+        # the same user gets a different pseudonym after every restart
+        self._salt = secrets.token_bytes(16)
+        self._last_update = time.monotonic()
+        self._lines: list[str] = []
+        self._flusher: asyncio.Task | None = None
+
+    def bind(self, path: str) -> None:
+        self.path = path
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _pseudonym(self, user_id: int) -> str:
+        digest = hashlib.blake2b(str(user_id).encode(), key=self._salt, digest_size=6)
+        return digest.hexdigest()
+
+    async def record(self, update) -> None:
+        now = time.monotonic()
+        if isinstance(update, types.CallbackQuery):
+            chat = update.message.chat if update.message else None
+        else:
+            chat = update.chat
+
+        # channel posts and inline messages aren't user traffic
+        if not update.from_user or not chat:
+            return
+
+        config = await config_cache.get()
+
+        if config and chat.id == config.staff_chat_id:
+            chat_kind = "staff"
+        elif chat.type == enums.ChatType.PRIVATE:
+            chat_kind = "private"
+        else:
+            chat_kind = "group"
+
+        line = {
+            "delay": round(now - self._last_update, 4),
+            "user": self._pseudonym(update.from_user.id),
+            "admin": bool(config and update.from_user.id in config.admins_list),
+            "chat": chat_kind,
+        }
+        self._last_update = now
+
+        if isinstance(update, types.CallbackQuery):
+            line["type"] = "callback_query"
+            line["data"] = NONCE.sub(":*", str(update.data))
+        else:
+            line["type"] = "message"
+            line.update(self._message_shape(update))
+
+        self._lines.append(json.dumps(line))
+        if not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    @staticmethod
+    def _message_shape(message: types.Message) -> dict:
+        shape = {}
+        if message.media:
+            shape["media"] = message.media.value
+
+        text = message.text or message.caption or ""
+        shape["length"] = len(text)
+        if text.startswith("/"):
+            # ids in commands like /unban_<id> are dropped, a serial number
+            # argument is only marked so it can be replayed against known users
+            words = text.split(maxsplit=2)
+            shape["command"] = DIGITS.sub("0", words[0])
+            shape["serial"] = len(words) > 1 and words[1].isdigit()
+        return shape
+
+    async def _flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            print(f"Failed to write the update trace, it says: {e}")
+
+    def _write(self, lines: list[str]) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+
+trace_recorder = TraceRecorder()
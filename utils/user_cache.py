@@ -0,0 +1,125 @@
+import asyncio
+from collections import OrderedDict
+
+from pymongo.asynchronous.collection import AsyncCollection
+
+from models.user import User
+from utils.change_streams import watch_forever
+from utils.metrics import USER_CACHE_LOOKUPS
+
+
+# bounded LRU of user documents by telegram id, with a serial number index for
+# staff commands, writes go through it and a change stream keeps bot instances
+# in sync, users that aren't registered aren't cached
+class UserCache:
+    def __init__(self):
+        self._collection: AsyncCollection | None = None
+        self._max_size = 10_000
+        self._users: OrderedDict[int, User] = OrderedDict()
+        self._serials: dict[int, int] = {}
+        self._version = 0
+        self._watcher: asyncio.Task | None = None
+
+    def bind(self, collection: AsyncCollection, max_size: int = 10_000) -> None:
+        self._collection = collection
+        self._max_size = max_size
+        self.clear()
+
+    async def get(self, user_id: int) -> User | None:
+        user = self._users.get(user_id)
+        if user:
+            self._users.move_to_end(user_id)
+            USER_CACHE_LOOKUPS.inc(key="id", result="hit")
+            return user
+
+        USER_CACHE_LOOKUPS.inc(key="id", result="miss")
+        return await self._load({"_id": user_id})
+
+    async def by_serial(self, serial_number: int) -> User | None:
+        user_id = self._serials.get(serial_number)
+        if user_id is not None:
+            self._users.move_to_end(user_id)
+            USER_CACHE_LOOKUPS.inc(key="serial", result="hit")
+            return self._users[user_id]
+
+        USER_CACHE_LOOKUPS.inc(key="serial", result="miss")
+        return await self._load({"serial_number": serial_number})
+
+    async def _load(self, query: dict) -> User | None:
+        version = self._version
+        doc = await self._collection.find_one(query, User.projection())
+        if not doc:
+            return None
+
+        user = User.from_doc(doc)
+        # don't cache a document that was changed while reading
+        if version == self._version:
+            self._store(user)
+        return user
+
+    def _store(self, user: User) -> None:
+        self._drop(user.id)
+        self._users[user.id] = user
+        self._serials[user.serial_number] = user.id
+        while len(self._users) > self._max_size:
+            _, evicted = self._users.popitem(last=False)
+            self._drop_serial(evicted)
+
+    def _drop(self, user_id: int) -> None:
+        user = self._users.pop(user_id, None)
+        if user:
+            self._drop_serial(user)
+
+    def _drop_serial(self, user: User) -> None:
+        # users registered before the serial counter may share a serial
+        # number, which then maps to the last one cached
+        if self._serials.get(user.serial_number) == user.id:
+            del self._serials[user.serial_number]
+
+    async def insert(self, user: User) -> None:
+        await self._collection.insert_one(user.to_doc())
+        self._version += 1
+        self._store(user)
+
+    async def update(self, user_id: int, fields: dict) -> None:
+        # `fields` are $set on the document and the cached user alike
+        await self._collection.update_one({"_id": user_id}, {"$set": fields})
+        self._version += 1
+        user = self._users.get(user_id)
+        if user:
+            user.apply(fields)
+
+    def invalidate(self, user_id: int) -> None:
+        self._version += 1
+        self._drop(user_id)
+
+    def clear(self) -> None:
+        self._version += 1
+        self._users.clear()
+        self._serials.clear()
+
+    def watch(self, client) -> None:
+        if not self._watcher:
+            self._watcher = asyncio.create_task(
+                watch_forever(
+                    client, self._collection, "Users", self._on_change, self.clear
+                )
+            )
+
+    def _on_change(self, change: dict) -> None:
+        operation = change["operationType"]
+        if operation not in ("update", "replace", "delete"):
+            # new users are cached on their first lookup, drop and rename
+            # events are followed by the end of the stream
+            if operation != "insert":
+                self.clear()
+            return
+
+        user_id = change["documentKey"]["_id"]
+        cached = user_id in self._users
+        self.invalidate(user_id)
+        if cached and change.get("fullDocument"):
+            self._store(User.from_doc(change["fullDocument"]))
+
+
+user_cache = UserCache()
@@ -0,0 +1,155 @@
+import asyncio
+import functools
+import sys
+import threading
+import time
+import traceback
+
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pyrogram import Client
+
+from utils.log import WARNING, log
+from utils.metrics import Counter, metrics
+
+# seconds between heartbeats of the event loop
+HEARTBEAT_INTERVAL = 0.1
+
+# seconds before the same blocking place is reported again
+REPORT_INTERVAL = 60
+
+# sync pymongo methods that do I/O, flagged in dev mode when called from the loop
+BLOCKING_COLLECTION_METHODS = (
+    "find_one",
+    "insert_one",
+    "insert_many",
+    "replace_one",
+    "update_one",
+    "update_many",
+    "delete_one",
+    "delete_many",
+    "find_one_and_update",
+    "find_one_and_delete",
+    "bulk_write",
+    "aggregate",
+    "count_documents",
+    "estimated_document_count",
+    "create_indexes",
+    "list_indexes",
+    "watch",
+)
+
+LOOP_BLOCKS = metrics.register(
+    Counter(
+        "masa_bot_event_loop_blocks_total",
+        "Times the event loop was blocked for longer than the watchdog threshold.",
+    )
+)
+
+
+# a thread that watches the event loop's heartbeat, when the loop stops
+# beating it captures the stack of whatever is running on the loop thread
+class LoopWatchdog:
+    def __init__(self):
+        self.threshold = 0.5
+        self._client: Client | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._heartbeat = time.monotonic()
+        # how late the last heartbeat was, read by the health endpoints
+        self.loop_lag = 0.0
+        self._reported: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def start(self, client: Client, threshold: float = 0.5, dev_mode=False) -> None:
+        # main() is called again after a crash, the watchdog keeps running
+        if self._thread:
+            return
+
+        self.threshold = threshold
+        self._client = client
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+
+        self._loop.create_task(self._beat())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+        if dev_mode:
+            self._flag_blocking_apis()
+
+    async def _beat(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.loop_lag = max(now - self._heartbeat - HEARTBEAT_INTERVAL, 0.0)
+            self._heartbeat = now
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def _watch(self) -> None:
+        blocked = False
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            lag = time.monotonic() - self._heartbeat - HEARTBEAT_INTERVAL
+            if lag < self.threshold:
+                blocked = False
+                continue
+
+            # one report per blocking episode, taken while it's still blocking
+            if blocked:
+                continue
+            blocked = True
+            LOOP_BLOCKS.inc()
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame:
+                stack = traceback.extract_stack(frame)
+                self._report(f"Event loop blocked for over {lag:.1f}s at:", stack)
+
+    def _report(self, title: str, stack: traceback.StackSummary) -> None:
+        # called from any thread, shipped once the loop runs again
+        place = f"{stack[-1].filename}:{stack[-1].lineno}"
+        now = time.monotonic()
+        with self._lock:
+            if now - self._reported.get(place, -REPORT_INTERVAL) < REPORT_INTERVAL:
+                return
+            self._reported[place] = now
+
+        text = f"{title}\n{''.join(stack.format())}"
+        self._loop.call_soon_threadsafe(self._ship, text)
+
+    def _ship(self, text: str) -> None:
+        asyncio.ensure_future(log(self._client, text, level=WARNING))
+
+    def _flagged(self, name: str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if threading.get_ident() == self._loop_thread_id:
+                # leave this wrapper out of the reported stack
+                stack = traceback.StackSummary.from_list(traceback.extract_stack()[:-1])
+                self._report(f"Blocking call {name} made from the event loop:", stack)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def _flag_blocking_apis(self) -> None:
+        for method in BLOCKING_COLLECTION_METHODS:
+            func = getattr(Collection, method)
+            setattr(Collection, method, self._flagged(f"Collection.{method}", func))
+
+        # find() only builds the cursor, fetching happens while iterating it
+        Cursor.next = Cursor.__next__ = self._flagged("Cursor.next", Cursor.next)
+
+        time.sleep = self._flagged("time.sleep", time.sleep)
+
+        try:
+            import requests
+        except ImportError:
+            return
+        requests.Session.request = self._flagged("requests", requests.Session.request)
+
+
+loop_watchdog = LoopWatchdog()